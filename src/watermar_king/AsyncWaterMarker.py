@@ -0,0 +1,345 @@
+# asyncio front-end of WaterMarker
+# Author: Khalid M. Chandio.
+
+import asyncio                      #Used to await watermarking calls running in executors
+import os                           #Used to get number of cores for the default executor size
+import threading                    #Used as cancellation token of calls running in threads
+import multiprocessing              #Used as cancellation token of calls running in processes
+import warnings                     #Used to report failing instruments without failing the call
+import queue                        #Used to receive PDF pages from calls running in threads
+from io import BytesIO              #Used to handle all operations in memory as BytesIO
+from collections import deque       #Used as the window of batch items in flight
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor  #Used to run the CPU bound work
+from .WaterMarker import WaterMarker, BatchResult, _callState, _checkCancelled
+
+
+# WaterMarkers of a process of the process executor per encoder parameters, created on first use
+_processMarkers = {}
+
+def _runCancellable(marker: WaterMarker, method: str, token, args: tuple, kwargs: dict, config: tuple=None):
+    """
+    Runs marker.method(*args, **kwargs) in an executor thread or process with token as the
+    cancellation token checked by the WaterMarker between pages, frames and processing stages.
+
+    When marker is None the call runs on a WaterMarker of the current worker process configured by
+    config, (encoder_params, instrumented) of the WaterMarker of the caller, and (result, records, error)
+    is returned: records are the instrumentation records of the call when instrumented, error is the
+    exception raised by the call, so its record is passed on as well.
+    """
+    records = None
+    if marker is None:
+        encoder_params, instrumented = config
+        key = repr(sorted((format, sorted(params.items())) for format, params in encoder_params.items()))
+        marker = _processMarkers.get(key)
+        if marker is None:
+            marker = _processMarkers[key] = WaterMarker(encoder_params)
+        records = [] if instrumented else None
+        # a worker process runs one call at a time, so the instrument is set per call
+        marker.instrument = None if records is None else records.append
+    _callState.cancel = token
+    try:
+        # the call may have been cancelled while it was queued
+        _checkCancelled()
+        if config is None:
+            return getattr(marker, method)(*args, **kwargs)
+        try:
+            return getattr(marker, method)(*args, **kwargs), records, None
+        except Exception as e:
+            return None, records, e
+    finally:
+        _callState.cancel = None
+
+
+class AsyncWaterMarker():
+    """
+    Awaitable versions of all WaterMarker methods for use within asyncio applications.
+
+    The CPU bound work runs in a thread or process executor so the event loop is never blocked.
+    The number of concurrent calls can be limited per media type (image, pdf, video, audio).
+    Cancelling an awaiting task stops the watermarking at its next check point (page, frame or
+    processing stage), removes its temporary files and only then releases its concurrency slot.
+
+    ::
+
+        awm = AsyncWaterMarker(executor="process", limits={"video": 1, "pdf": 2})
+        out = await awm.WaterMark_PDF(pdf, "Confidential")
+        await awm.close()
+
+    """
+
+    mediaTypes = ("image", "pdf", "video", "audio")
+
+    def __init__(self, marker: WaterMarker=None, executor="thread", max_workers: int=None, limits: dict=None):
+        """
+        :param marker: WaterMarker used for calls running in threads. Default creates a new one.
+            Calls running in processes use a WaterMarker of the worker process with the encoder_params of
+            marker, and pass their instrumentation records back to the instrument of marker. A marker with
+            a result_cache can not be used with processes, as the workers would not share it.
+
+        :param executor: "thread" (default), "process" or an Executor instance. Arguments and results of
+            calls running in processes are pickled, so file-like sinks (out) only work with threads.
+
+        :param max_workers: Size of the executor created for "thread" or "process". Default uses all cores.
+
+        :param limits: Maximum number of concurrent calls per media type, e.g. {"video": 1}.
+            Media types which are not given are only limited by the executor.
+        """
+        self.marker = marker if marker is not None else WaterMarker()
+        max_workers = max_workers or os.cpu_count() or 1
+        self._ownsExecutor = not isinstance(executor, Executor)
+        if executor == "thread":
+            executor = ThreadPoolExecutor(max_workers=max_workers)
+        elif executor == "process":
+            executor = ProcessPoolExecutor(max_workers=max_workers)
+        elif self._ownsExecutor:
+            raise ValueError(f"Unknown executor {executor!r}, use 'thread', 'process' or an Executor")
+        self.executor = executor
+        # items of a batch in flight, as the batch of WaterMarker keeps twice its workers busy
+        self._batchWindow = 2 * (getattr(executor, "_max_workers", None) or max_workers)
+        self._inProcess = isinstance(executor, ProcessPoolExecutor)
+        if self._inProcess and self.marker.result_cache is not None:
+            if self._ownsExecutor:
+                executor.shutdown()
+            raise ValueError("A marker with a result_cache can not be used with a process executor, use a thread executor")
+        self._manager = None
+        limits = limits or {}
+        for media in limits:
+            if media not in self.mediaTypes:
+                raise ValueError(f"Unknown media type {media!r}, use one of {', '.join(self.mediaTypes)}")
+        self._limits = {media: asyncio.Semaphore(limits[media]) if limits.get(media) else None for media in self.mediaTypes}
+
+    async def close(self):
+        """
+        Shuts down the executor created by this object, waiting for running calls.
+        """
+        if self._ownsExecutor:
+            await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+        if self._manager is not None:
+            self._manager.shutdown()
+            self._manager = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _newToken(self):
+        # threads share a plain event, processes need an event served by a manager process
+        if not self._inProcess:
+            return threading.Event()
+        return self._getManager().Event()
+
+    def _newQueue(self, maxsize: int):
+        # threads share a plain queue, processes need a queue served by a manager process
+        if not self._inProcess:
+            return queue.Queue(maxsize)
+        return self._getManager().Queue(maxsize)
+
+    def _getManager(self):
+        if self._manager is None:
+            self._manager = multiprocessing.Manager()
+        return self._manager
+
+    async def _run(self, media: str, method: str, *args, **kwargs):
+        """
+        :Private Function:
+
+        Runs WaterMarker.method in the executor within the concurrency limit of media.
+        """
+        limit = self._limits[media]
+        if limit is not None:
+            await limit.acquire()
+        try:
+            token = self._newToken()
+            if self._inProcess:
+                config = (self.marker.encoder_params, self.marker.instrument is not None)
+                future = asyncio.get_running_loop().run_in_executor(self.executor, _runCancellable, None, method, token, args, kwargs, config)
+            else:
+                future = asyncio.get_running_loop().run_in_executor(self.executor, _runCancellable, self.marker, method, token, args, kwargs)
+            try:
+                result = await asyncio.shield(future)
+                if not self._inProcess:
+                    return result
+                result, records, error = result
+                for record in records or ():
+                    try:
+                        self.marker.instrument(record)
+                    except Exception as e:
+                        warnings.warn(f"Instrument of WaterMarker failed: {e!r}", RuntimeWarning)
+                if error is not None:
+                    raise error
+                return result
+            except asyncio.CancelledError:
+                # stop the work and wait until it has cleaned up before giving the slot back
+                token.set()
+                await asyncio.wait([future])
+                if not future.cancelled():
+                    future.exception()
+                raise
+        finally:
+            if limit is not None:
+                limit.release()
+
+    async def WaterMark_PNG(self, img: bytes, text_to_write: str, max_size=None, workers: int=None) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_PNG.
+        """
+        return await self._run("image", "WaterMark_PNG", img, text_to_write, max_size, workers)
+
+    async def WaterMark_TIFF(self, img: bytes, text_to_write: str, max_size=None, workers: int=None) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_TIFF.
+        """
+        return await self._run("image", "WaterMark_TIFF", img, text_to_write, max_size, workers)
+
+    async def WaterMark_TIFF_Tiled(self, source: str, target: str, text_to_write: str, **kwargs) -> str:
+        """
+        Awaitable WaterMarker.WaterMark_TIFF_Tiled.
+        """
+        return await self._run("image", "WaterMark_TIFF_Tiled", source, target, text_to_write, **kwargs)
+
+    async def WaterMark_JPEG(self, img: bytes, text_to_write: str, max_size=None) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_JPEG.
+        """
+        return await self._run("image", "WaterMark_JPEG", img, text_to_write, max_size)
+
+    async def WaterMark_BMP(self, img: bytes, text_to_write: str, max_size=None) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_BMP.
+        """
+        return await self._run("image", "WaterMark_BMP", img, text_to_write, max_size)
+
+    async def WaterMark(self, data: bytes, text_to_write: str, format: str=None, **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark. The format is detected in the event loop, which only looks at the
+        first bytes, to pick the concurrency limit of its media type.
+        """
+        if format is None:
+            format = self.marker.detect_format(data)
+            if format is None:
+                raise ValueError("Could not detect the format of the given data")
+        handler = self.marker._handlers.get(format.lower())
+        if handler is None:
+            raise ValueError(f"No handler registered for format {format!r}")
+        return await self._run(handler.media, "WaterMark", data, text_to_write, format=format, **kwargs)
+
+    async def WaterMark_Batch(self, items, ordered: bool=True, window: int=None, **kwargs):
+        """
+        Asynchronous generator version of WaterMarker.WaterMark_Batch yielding a BatchResult per item.
+        Every item is a separate call within the concurrency limit of its media type. Items are read from
+        the iterable as calls finish, with at most window of them in flight, so large batches are never
+        held in memory at once.
+
+        :param items: Iterable of (bytes, text_to_write, format) tuples, format None detects it.
+
+        :param ordered: True (default) yields results in the order of items, False yields them as they complete.
+
+        :param window: Maximum number of items in flight. Default is twice the workers of the executor.
+
+        :param kwargs: Passed on to WaterMark for every item, e.g. max_size.
+        """
+        async def one(index, item):
+            img, text_to_write, format = item
+            try:
+                return BatchResult(index, await self.WaterMark(img, text_to_write, format=format, **kwargs), None)
+            except Exception as e:
+                return BatchResult(index, None, e)
+
+        window = window or self._batchWindow
+        items = enumerate(items)
+        pending = deque()
+        def submit():
+            for index, item in items:
+                pending.append(asyncio.ensure_future(one(index, item)))
+                return True
+            return False
+
+        try:
+            while len(pending) < window and submit():
+                pass
+            while pending:
+                if ordered:
+                    task = pending.popleft()
+                    result = await task
+                    submit()
+                    yield result
+                    continue
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    pending.remove(task)
+                    submit()
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def WaterMark_Video(self, video: bytes, text_to_write: str="WaterMark", extension: str="mp4", **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_Video.
+        """
+        return await self._run("video", "WaterMark_Video", video, text_to_write, extension, **kwargs)
+
+    async def WaterMark_PDF(self, pdf: bytes, text_to_write: str, **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_PDF, keyword arguments are passed on.
+        """
+        return await self._run("pdf", "WaterMark_PDF", pdf, text_to_write, **kwargs)
+
+    async def WaterMark_PDF_Pages(self, pdf: bytes, text_to_write: str, pages=None, **kwargs):
+        """
+        Asynchronous generator version of WaterMarker.WaterMark_PDF_Pages yielding (index, bytes) per page in
+        document order. All pages are watermarked by one call within the concurrency limit of pdf, which
+        opens the document once and hands every page over as soon as it is done, so the first page is
+        yielded without waiting for the rest. The call works up to two pages ahead of the reader and is
+        cancelled when the generator is closed early.
+        """
+        pageQueue = self._newQueue(2)
+        job = asyncio.ensure_future(self._run("pdf", "_waterMarkPdfPagesInto", pageQueue, pdf, text_to_write, pages, **kwargs))
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                page = await loop.run_in_executor(None, pageQueue.get)
+                if page is None:
+                    break
+                yield page
+            # raises the error of the call, if any
+            await job
+        finally:
+            if not job.done():
+                job.cancel()
+                await asyncio.wait([job])
+                if not job.cancelled():
+                    job.exception()
+            # releases a read still waiting in the default executor when the call never started
+            try:
+                pageQueue.put_nowait(None)
+            except queue.Full:
+                pass
+
+    async def WaterMark_WAV(self, audio: bytes, text_to_write: str, voice_index: int=28, **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_WAV.
+        """
+        return await self._run("audio", "WaterMark_WAV", audio, text_to_write, voice_index, **kwargs)
+
+    async def WaterMark_OGG(self, audio: bytes, text_to_write: str, voice_index: int=28, **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_OGG.
+        """
+        return await self._run("audio", "WaterMark_OGG", audio, text_to_write, voice_index, **kwargs)
+
+    async def WaterMark_MP3(self, audio: bytes, text_to_write: str, voice_index: int=28, **kwargs) -> BytesIO:
+        """
+        Awaitable WaterMarker.WaterMark_MP3.
+        """
+        return await self._run("audio", "WaterMark_MP3", audio, text_to_write, voice_index, **kwargs)
+
+    async def WaterMark_AudioStream(self, source, sink, text_to_write: str, format: str="wav", **kwargs):
+        """
+        Awaitable WaterMarker.WaterMark_AudioStream. source and sink are file-like objects, so it only works
+        with a thread executor.
+        """
+        return await self._run("audio", "WaterMark_AudioStream", source, sink, text_to_write, format, **kwargs)
@@ -0,0 +1,103 @@
+# Prometheus style collector of WaterMarker instrumentation
+# Author: Khalid M. Chandio.
+
+import threading                    #Used to guard the counters updated by concurrent calls
+from bisect import bisect_left      #Used to find the histogram bucket of a call
+
+
+class MetricsCollector():
+    """
+    Instrument of WaterMarker aggregating the records of calls into counters and a latency histogram,
+    exposed in the Prometheus text format by render().
+
+    ::
+
+        metrics = MetricsCollector()
+        wm = WaterMarker(instrument=metrics)
+        wm.WaterMark_PDF(pdf, "Confidential")
+        print(metrics.render())
+
+    Metrics, labelled by method:
+
+    - watermarker_calls_total: calls, also labelled by status (ok or the exception name)
+    - watermarker_call_seconds: histogram of the call durations
+    - watermarker_stage_seconds_total: seconds spent per stage (decode, render, overlay, blend, encode, ...)
+    - watermarker_items_total: counts per item (bytes_in, bytes_out, pages, frames, samples, ...)
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self, prefix: str="watermarker", buckets: tuple=None):
+        """
+        :param prefix: Prefix of the metric names.
+
+        :param buckets: Upper bounds of the histogram buckets in seconds, in increasing order.
+        """
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._histograms = {}
+        self._stages = {}
+        self._items = {}
+
+    def __call__(self, record: dict):
+        """
+        Adds the record of one call, as passed by WaterMarker to its instrument.
+        """
+        method = record["method"]
+        status = record["error"] or "ok"
+        with self._lock:
+            self._calls[method, status] = self._calls.get((method, status), 0) + 1
+            histogram = self._histograms.get(method)
+            if histogram is None:
+                # counts per bucket plus +Inf, then sum
+                histogram = self._histograms[method] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect_left(self.buckets, record["seconds"])] += 1
+            histogram[1] += record["seconds"]
+            for stage, seconds in record["stages"].items():
+                self._stages[method, stage] = self._stages.get((method, stage), 0.0) + seconds
+            for item, count in record["counts"].items():
+                self._items[method, item] = self._items.get((method, item), 0) + count
+
+    def reset(self):
+        """
+        Sets all metrics back to zero.
+        """
+        with self._lock:
+            self._calls.clear()
+            self._histograms.clear()
+            self._stages.clear()
+            self._items.clear()
+
+    def render(self) -> str:
+        """
+        Returns all metrics in the Prometheus text exposition format.
+        """
+        p = self.prefix
+        lines = []
+        with self._lock:
+            lines += [f"# HELP {p}_calls_total Calls of WaterMarker methods.", f"# TYPE {p}_calls_total counter"]
+            for (method, status), count in sorted(self._calls.items()):
+                lines.append(f'{p}_calls_total{{method="{method}",status="{status}"}} {count}')
+
+            lines += [f"# HELP {p}_call_seconds Duration of WaterMarker calls.", f"# TYPE {p}_call_seconds histogram"]
+            for method, (counts, total) in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f'{p}_call_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+                lines.append(f'{p}_call_seconds_sum{{method="{method}"}} {total!r}')
+                lines.append(f'{p}_call_seconds_count{{method="{method}"}} {cumulative}')
+
+            lines += [f"# HELP {p}_stage_seconds_total Seconds spent in the stages of WaterMarker calls.",
+                      f"# TYPE {p}_stage_seconds_total counter"]
+            for (method, stage), seconds in sorted(self._stages.items()):
+                lines.append(f'{p}_stage_seconds_total{{method="{method}",stage="{stage}"}} {seconds!r}')
+
+            lines += [f"# HELP {p}_items_total Bytes, pages, frames and samples processed by WaterMarker calls.",
+                      f"# TYPE {p}_items_total counter"]
+            for (method, item), count in sorted(self._items.items()):
+                lines.append(f'{p}_items_total{{method="{method}",item="{item}"}} {count}')
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,286 @@
+# Content addressed cache of watermarked outputs
+# Author: Khalid M. Chandio.
+
+import os                           #Used to keep cached outputs as files
+import tempfile                     #Used to write cached outputs under a temporary name first
+import threading                    #Used to guard the stores and the calls in flight
+import hashlib                      #Used to address outputs by the content of their inputs
+from collections import OrderedDict #Used as LRU index of the stores
+from .WaterMarker import _privateDirectory, _userId
+
+
+class MemoryStore():
+    """
+    Store of ResultCache keeping outputs in memory, least recently used ones are evicted first
+    when their total size is over max_bytes.
+    """
+    def __init__(self, max_bytes: int=256 * 1024 * 1024):
+        """
+        :param max_bytes: Memory budget of the store in bytes.
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key: str) -> bytes:
+        """
+        Returns the output stored against key, None if there is none.
+        """
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key: str, value: bytes):
+        """
+        Stores value against key unless it is larger than the whole budget.
+        """
+        with self._lock:
+            if len(value) > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = value
+            self._bytes += len(value)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+
+    def clear(self):
+        """
+        Removes all outputs. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+
+class DiskStore():
+    """
+    Store of ResultCache keeping outputs as files in directory, least recently used ones are removed
+    first when their total size is over max_bytes. Files written by other processes using the same
+    directory are served too, and are counted against max_bytes from the next start.
+    """
+    def __init__(self, directory: str=None, max_bytes: int=1024 * 1024 * 1024):
+        """
+        :param directory: Folder of the output files, created readable by the current user only if needed.
+            Default is watermar_king_results-<user id> in the temporary folder of the system. Raises ValueError
+            if it is not owned by the current user or others can write to it, as its files are served as they are.
+
+        :param max_bytes: Disk budget of the store in bytes.
+        """
+        self.directory = os.path.join(tempfile.gettempdir(), "watermar_king_results-" + _userId()) if directory is None else directory
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+        if not _privateDirectory(self.directory):
+            raise ValueError(f"Result folder {self.directory} must be owned by the current user and not writable by others")
+        # index the files left by earlier runs, oldest first
+        files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".out")]
+        for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+            self._entries[entry.name[:-4]] = entry.stat().st_size
+            self._bytes += entry.stat().st_size
+        with self._lock:
+            self._evict()
+
+    def get(self, key: str) -> bytes:
+        """
+        Returns the output stored against key, None if there is none.
+        """
+        try:
+            with open(self._path(key), "rb") as file:
+                value = file.read()
+            # modification time orders the files by use for the index of the next start
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._bytes -= size
+            return None
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes):
+        """
+        Writes value to the file of key unless it is larger than the whole budget.
+        """
+        if len(value) > self.max_bytes:
+            return
+        # written under another name and renamed, so readers never see a partial output
+        try:
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            with os.fdopen(fd, "wb") as file:
+                file.write(value)
+            os.replace(path, self._path(key))
+        except OSError:
+            return
+        with self._lock:
+            self._bytes += len(value) - self._entries.pop(key, 0)
+            self._entries[key] = len(value)
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all output files of the directory. Counters are kept.
+        """
+        with self._lock:
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".out"):
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes, "evictions": self.evictions}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".out")
+
+    def _evict(self):
+        # must be called with the lock held
+        while self._bytes > self.max_bytes and self._entries:
+            key, size = self._entries.popitem(last=False)
+            self._bytes -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+
+def _normalised(value):
+    """
+    Returns value with the items of dicts and sets, also nested ones, in sorted order and lists as tuples,
+    so equal arguments have the same repr whatever order they were built in.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((key, _normalised(item)) for key, item in value.items()))
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(_normalised(item) for item in value))
+    if isinstance(value, (list, tuple)):
+        return tuple(_normalised(item) for item in value)
+    return value
+
+
+class _flight():
+    """
+    Computation of an output in progress, waited for by identical calls.
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+
+
+class ResultCache():
+    """
+    Content addressed cache of the outputs of WaterMarker calls.
+
+    Watermarking the same document with the same text and parameters always gives the same output, so
+    it is computed once and served from store afterwards. Outputs are keyed by the sha256 of the input
+    bytes, the method, the watermark text, all other arguments and the encoder parameters of the
+    WaterMarker. Identical calls running at the same time compute the output only once, the others wait
+    for it.
+
+    ::
+
+        wm = WaterMarker(result_cache=ResultCache(DiskStore("/var/cache/watermarks", max_bytes=10 * 2**30)))
+        out = wm.WaterMark_PDF(pdf, "Confidential")
+
+    store is MemoryStore, DiskStore or any object with get(key), put(key, value), clear() and stats().
+    """
+    def __init__(self, store=None):
+        """
+        :param store: Storage of the outputs. Default is a MemoryStore of 256 MB.
+        """
+        self.store = store if store is not None else MemoryStore()
+        self._flights = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def key(data: bytes, method: str, arguments: dict, encoder_params: dict=None) -> str:
+        """
+        Returns the content address of the output of method called on data with arguments. arguments and
+        encoder_params are normalised, so the order their items were given in does not matter.
+        """
+        digest = hashlib.sha256(data)
+        digest.update(repr((method, _normalised(arguments), _normalised(encoder_params or {}))).encode())
+        return digest.hexdigest()
+
+    def fetch(self, key: str, compute) -> bytes:
+        """
+        Returns the output stored against key. On a miss compute() is called and the bytes it returns
+        are stored, while identical fetches wait for it. compute() may return None for outputs which are
+        not to be cached.
+        """
+        while True:
+            value = self.store.get(key)
+            if value is not None:
+                self._saved(len(value))
+                return value
+            with self._lock:
+                flight = self._flights.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._flights[key] = _flight()
+            if leader:
+                break
+            flight.done.wait()
+            if flight.value is not None:
+                self._saved(len(flight.value), shared=True)
+                return flight.value
+            # the first call failed or gave an output which is not cached, try again
+
+        try:
+            with self._lock:
+                self.misses += 1
+            flight.value = compute()
+            if flight.value is not None:
+                self.store.put(key, flight.value)
+            return flight.value
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+    def clear(self):
+        """
+        Removes all outputs from store. Counters are kept.
+        """
+        self.store.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns counters of the cache for monitoring. hits are served from store, shared by an identical
+        call running at the same time, bytes_saved counts the output bytes of both.
+        """
+        with self._lock:
+            stats = {"hits": self.hits, "shared": self.shared, "misses": self.misses, "bytes_saved": self.bytes_saved}
+        stats.update(self.store.stats())
+        return stats
+
+    def _saved(self, size: int, shared: bool=False):
+        with self._lock:
+            if shared:
+                self.shared += 1
+            else:
+                self.hits += 1
+            self.bytes_saved += size
@@ -0,0 +1,389 @@
+# Pre-fork HTTP service of WaterMarker
+# Author: Khalid M. Chandio.
+
+import os                           #Used to fork and supervise the worker processes
+import sys                          #Used to exit worker processes without running the cleanup of the parent
+import signal                       #Used to stop the service and its workers
+import socket                       #Used to open the listening socket shared by all workers
+import time                         #Used to report the uptime of workers
+import argparse                     #Used to run the service from the command line
+from multiprocessing import RawArray #Used as counters shared by the parent and the workers
+from urllib.parse import urlsplit, parse_qs  #Used to read the options of a request
+from http.server import BaseHTTPRequestHandler, HTTPServer  #Used to serve HTTP in the workers
+from .WaterMarker import WaterMarker, preload, _getOutsideBandsBlend
+
+
+# Content types of the watermarked outputs per format
+_contentTypes = {
+    "jpeg": "image/jpeg", "jpg": "image/jpeg", "png": "image/png", "tiff": "image/tiff", "tif": "image/tiff",
+    "bmp": "image/bmp", "pdf": "application/pdf", "mp4": "video/mp4", "avi": "video/x-msvideo",
+    "webm": "video/webm", "ogv": "video/ogg", "wav": "audio/wav", "ogg": "audio/ogg", "mp3": "audio/mpeg",
+}
+
+# Counters per worker slot in the shared array: pid, busy, jobs of the current process, jobs of the slot,
+# failed jobs of the slot, start time of the current process
+_slotFields = 6
+_PID, _BUSY, _JOBS, _TOTAL, _FAILED, _STARTED = range(_slotFields)
+
+
+class WaterMarkServer():
+    """
+    Pre-fork HTTP service watermarking the bodies POSTed to /watermark.
+
+    The parent process opens the listening socket, imports the media backends and warms the overlay and
+    speech caches, then forks the workers, which share that memory copy-on-write and accept connections
+    from the same socket. A worker exits after max_jobs requests and the parent forks a new one in its
+    place, so memory growth of long running workers is bounded. Needs fork, i.e. Linux or macOS.
+
+    Endpoints:
+
+    - POST /watermark?text=...&format=...&max_size=...&mode=... : body is the file, the response the
+      watermarked file. format is detected when not given, max_size applies to images, mode to PDFs.
+    - GET /metrics : queue depth of the listening socket and load per worker in the Prometheus text format.
+    - GET /health : 200 while the worker serves.
+
+    ::
+
+        server = WaterMarkServer(port=8080, workers=4, max_jobs=500, warm_texts=["Confidential"])
+        server.serve_forever()
+
+    or from the command line: python -m watermar_king.WaterMarkServer --port 8080 --workers 4 --warm-text Confidential
+    """
+
+    # Frame sizes warmed by default: A4 and Letter pages rendered by WaterMark_PDF, full HD and 4K frames
+    warm_sizes = ((1190, 1684), (1224, 1584), (1920, 1080), (3840, 2160))
+
+    def __init__(self, host: str="127.0.0.1", port: int=8080, unix_socket: str=None, workers: int=None,
+                 max_jobs: int=1000, media=("image", "pdf", "video"), warm_texts=(), warm_sizes=None,
+                 marker: WaterMarker=None, max_body: int=1 << 30, backlog: int=128):
+        """
+        :param host: Address to listen on.
+
+        :param port: TCP port to listen on, 0 picks a free one (see address).
+
+        :param unix_socket: Path of a Unix socket to listen on instead of host and port.
+
+        :param workers: Number of worker processes. Default uses all cores.
+
+        :param max_jobs: Requests served by a worker before it is replaced by a new one. 0 never replaces them.
+
+        :param media: Media types whose backends are imported before forking, see watermar_king.preload.
+
+        :param warm_texts: Texts whose overlays (for warm_sizes) and, with audio in media, spoken clips are
+            created before forking.
+
+        :param warm_sizes: (width, height) of the overlays to warm. Default warm_sizes of the class.
+
+        :param marker: WaterMarker used by the workers, e.g. with encoder parameters. Default creates one.
+
+        :param max_body: Largest accepted request body in bytes.
+
+        :param backlog: Length of the queue of connections waiting to be accepted.
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.max_jobs = max_jobs
+        self.media = tuple(media)
+        self.warm_texts = tuple(warm_texts)
+        if warm_sizes is not None:
+            self.warm_sizes = tuple(warm_sizes)
+        self.marker = marker if marker is not None else WaterMarker()
+        self.max_body = max_body
+        self.unix_socket = unix_socket
+
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.remove(unix_socket)
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.bind(unix_socket)
+        else:
+            self.socket = socket.create_server((host, port), family=socket.AF_INET6 if ":" in host else socket.AF_INET)
+        self.socket.listen(backlog)
+        self.address = self.socket.getsockname()
+
+        # restarts of workers, then the counters of every slot
+        self._counters = RawArray("q", 1 + self.workers * _slotFields)
+        self._children = {}
+        self._stopping = False
+
+    def warm(self):
+        """
+        Imports the backends of media and creates the overlays and spoken clips of warm_texts, so that forked
+        workers start with them. Called by serve_forever before forking.
+        """
+        preload(*self.media)
+        if any(kind in self.media for kind in ("image", "pdf", "video")):
+            _getOutsideBandsBlend()
+            for text_to_write in self.warm_texts:
+                for width, height in self.warm_sizes:
+                    self.marker._getWaterMarkBands((height, width, 3), text_to_write)
+        if "audio" in self.media and self.warm_texts:
+            self.marker.speech_cache.warm(self.warm_texts)
+
+    def serve_forever(self):
+        """
+        Warms the caches, forks the workers and replaces the ones which exit until SIGTERM or SIGINT,
+        which stop the workers after their current request.
+        """
+        self.warm()
+        previous = {sig: signal.signal(sig, self._stop) for sig in (signal.SIGTERM, signal.SIGINT)}
+        try:
+            for slot in range(self.workers):
+                self._fork(slot)
+            while self._children:
+                try:
+                    pid, _ = os.wait()
+                except ChildProcessError:
+                    break
+                except InterruptedError:
+                    continue
+                slot = self._children.pop(pid, None)
+                if slot is None:
+                    continue
+                self._counter(slot, _PID, 0)
+                self._counter(slot, _BUSY, 0)
+                if not self._stopping:
+                    self._counters[0] += 1
+                    self._fork(slot)
+        finally:
+            for sig, handler in previous.items():
+                signal.signal(sig, handler)
+            self.close()
+
+    def close(self):
+        """
+        Closes the listening socket.
+        """
+        self.socket.close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.remove(self.unix_socket)
+
+    def queue_depth(self):
+        """
+        Returns the number of connections waiting to be accepted, read from /proc/net/tcp on Linux.
+        None where it is not available, e.g. for Unix sockets.
+        """
+        if self.unix_socket:
+            return None
+        inode = str(os.fstat(self.socket.fileno()).st_ino)
+        for table in ("/proc/net/tcp", "/proc/net/tcp6"):
+            try:
+                with open(table) as file:
+                    next(file)
+                    for line in file:
+                        fields = line.split()
+                        # st 0A is LISTEN, where rx_queue is the length of the accept queue
+                        if fields[9] == inode and fields[3] == "0A":
+                            return int(fields[4].split(":")[1], 16)
+            except OSError:
+                continue
+        return None
+
+    def stats(self) -> dict:
+        """
+        Returns the queue depth, restarts and per worker counters, as served by /metrics.
+        """
+        now = time.time()
+        workers = []
+        for slot in range(self.workers):
+            pid, busy, jobs, total, failed, started = (self._counter(slot, field) for field in range(_slotFields))
+            workers.append({"slot": slot, "pid": pid, "busy": busy, "jobs": jobs, "jobs_total": total,
+                            "failed_total": failed, "uptime": now - started if started else 0.0})
+        return {"queue_depth": self.queue_depth(), "restarts": self._counters[0],
+                "busy": sum(worker["busy"] for worker in workers), "workers": workers}
+
+    def _counter(self, slot: int, field: int, value: int=None) -> int:
+        index = 1 + slot * _slotFields + field
+        if value is not None:
+            self._counters[index] = value
+        return self._counters[index]
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _fork(self, slot: int):
+        pid = os.fork()
+        if pid:
+            self._children[pid] = slot
+            self._counter(slot, _PID, pid)
+            return
+        # worker process, never returns into the code of the parent
+        status = 0
+        try:
+            self._work(slot)
+        except BaseException:
+            status = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(status)
+
+    def _work(self, slot: int):
+        """
+        :Private Function:
+
+        Body of a worker process: serves requests from the shared socket until max_jobs or SIGTERM.
+        """
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self._counter(slot, _JOBS, 0)
+        self._counter(slot, _BUSY, 0)
+        self._counter(slot, _STARTED, int(time.time()))
+        # all workers wait on the socket, the ones which lose a connection to another must not block in accept
+        self.socket.setblocking(False)
+        server = _workerHTTPServer(self, slot)
+        while not stopping and not (self.max_jobs and self._counter(slot, _JOBS) >= self.max_jobs):
+            server.handle_request()
+
+
+class _workerHTTPServer(HTTPServer):
+    """
+    HTTPServer of a worker, accepting from the listening socket of the WaterMarkServer.
+    """
+    # seconds handle_request waits for a connection, so stop requests are seen
+    timeout = 0.5
+
+    def __init__(self, service: WaterMarkServer, slot: int):
+        HTTPServer.__init__(self, service.address, _requestHandler, bind_and_activate=False)
+        # serve from the shared socket instead of the one created for us
+        self.socket.close()
+        self.socket = service.socket
+        self.service = service
+        self.slot = slot
+
+    def handle_timeout(self):
+        pass
+
+
+class _requestHandler(BaseHTTPRequestHandler):
+    """
+    Handler of the requests to a worker. Connections are closed after every response (HTTP/1.0), so a
+    request is a job and an idle client never holds a worker.
+    """
+    # seconds a client may take to send its request
+    timeout = 60
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status: int, body, content_type: str="text/plain; charset=utf-8", headers: dict=None):
+        if isinstance(body, str):
+            body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path == "/health":
+            self._reply(200, "ok\n")
+        elif path == "/metrics":
+            self._reply(200, self._metrics(), "text/plain; version=0.0.4; charset=utf-8")
+        else:
+            self._reply(404, "not found\n")
+
+    def do_POST(self):
+        url = urlsplit(self.path)
+        if url.path != "/watermark":
+            return self._reply(404, "not found\n")
+        service, slot = self.server.service, self.server.slot
+        service._counter(slot, _BUSY, 1)
+        try:
+            status, body, content_type, headers = self._watermark(service, parse_qs(url.query))
+        finally:
+            service._counter(slot, _BUSY, 0)
+            service._counter(slot, _JOBS, service._counter(slot, _JOBS) + 1)
+            service._counter(slot, _TOTAL, service._counter(slot, _TOTAL) + 1)
+        if status != 200:
+            service._counter(slot, _FAILED, service._counter(slot, _FAILED) + 1)
+        self._reply(status, body, content_type, headers)
+
+    def _watermark(self, service: WaterMarkServer, query: dict) -> tuple:
+        """
+        :Private Function:
+
+        Watermarks the body of the request and returns (status, body, content type, headers).
+        """
+        text_to_write = query.get("text", [None])[0]
+        if not text_to_write:
+            return 400, "text is required\n", "text/plain; charset=utf-8", None
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            return 411, "Content-Length is required\n", "text/plain; charset=utf-8", None
+        if length > service.max_body:
+            # the body is not read, so the connection can not be reused
+            self.close_connection = True
+            return 413, "body too large\n", "text/plain; charset=utf-8", None
+        data = self.rfile.read(length)
+
+        marker = service.marker
+        format = query.get("format", [None])[0] or marker.detect_format(data)
+        if format is None:
+            return 415, "format could not be detected\n", "text/plain; charset=utf-8", None
+        kwargs = {}
+        try:
+            if "max_size" in query:
+                kwargs["max_size"] = int(query["max_size"][0])
+            if "mode" in query:
+                kwargs["mode"] = query["mode"][0]
+            out = marker.WaterMark(data, text_to_write, format=format, **kwargs)
+        except (ValueError, TypeError) as e:
+            return 400, f"{e}\n", "text/plain; charset=utf-8", None
+        except Exception as e:
+            return 500, f"{type(e).__name__}: {e}\n", "text/plain; charset=utf-8", None
+        return 200, out.getbuffer(), _contentTypes.get(format.lower(), "application/octet-stream"), {"X-Format": format.lower()}
+
+    def _metrics(self) -> str:
+        stats = self.server.service.stats()
+        lines = ["# HELP watermarkserver_queue_depth Connections waiting to be accepted.",
+                 "# TYPE watermarkserver_queue_depth gauge"]
+        if stats["queue_depth"] is not None:
+            lines.append(f"watermarkserver_queue_depth {stats['queue_depth']}")
+        lines += ["# HELP watermarkserver_busy_workers Workers serving a request.", "# TYPE watermarkserver_busy_workers gauge",
+                  f"watermarkserver_busy_workers {stats['busy']}",
+                  "# HELP watermarkserver_worker_restarts_total Workers replaced after max_jobs or a crash.",
+                  "# TYPE watermarkserver_worker_restarts_total counter",
+                  f"watermarkserver_worker_restarts_total {stats['restarts']}"]
+        for name, field, kind, help in (("busy", "busy", "gauge", "1 while the worker serves a request."),
+                                        ("jobs", "jobs", "gauge", "Requests served by the current process of the worker."),
+                                        ("jobs_total", "jobs_total", "counter", "Requests served by the worker slot."),
+                                        ("failed_total", "failed_total", "counter", "Requests of the worker slot which failed."),
+                                        ("uptime_seconds", "uptime", "gauge", "Age of the current process of the worker.")):
+            lines += [f"# HELP watermarkserver_worker_{name} {help}", f"# TYPE watermarkserver_worker_{name} {kind}"]
+            for worker in stats["workers"]:
+                lines.append(f'watermarkserver_worker_{name}{{slot="{worker["slot"]}"}} {worker[field]:g}')
+        return "\n".join(lines) + "\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Pre-fork HTTP service watermarking files POSTed to /watermark")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--unix-socket", help="Listen on this Unix socket instead of host and port")
+    parser.add_argument("--workers", type=int, help="Worker processes, default all cores")
+    parser.add_argument("--max-jobs", type=int, default=1000, help="Requests per worker before it is replaced, 0 never")
+    parser.add_argument("--media", default="image,pdf,video", help="Media types to preload, comma separated")
+    parser.add_argument("--warm-text", action="append", default=[], help="Text to warm the caches with, may be repeated")
+    args = parser.parse_args()
+    server = WaterMarkServer(args.host, args.port, args.unix_socket, args.workers, args.max_jobs,
+                             [kind for kind in args.media.split(",") if kind], args.warm_text)
+    print(f"Serving on {server.address} with {server.workers} workers", flush=True)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
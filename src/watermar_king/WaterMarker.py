@@ -1,13 +1,822 @@
 # Module to watermark images, PDFs, Videos and Audios
 # Author: Khalid M. Chandio.
 
-import cv2, numpy as np             #Used to create and merge watermark
+import numpy as np                  #Used to create and merge watermark
+import importlib                    #Used to import the media backends on first use
 from io import BytesIO              #Used to handle all operations in memory as BytesIO
-import tempfile                     #Used to save temp files
-import pypdfium2 as pdfium          #Used to extract pages from pdf files as images
-from moviepy import editor as mpE   #Used to edit videos. This requires ImageMagick to be installed and path included in env variables.
-import pyttsx3                      #Used to create computer generated voice for watermarking audios
-from pydub import AudioSegment      #Used to overlay audio files
+import tempfile                     #Used to save temp files where memory backed files are not available
+import threading                    #Used to guard the shared overlay cache
+import os                           #Used to get number of cores for parallel processing
+import hashlib                      #Used to address cached speech clips by their content
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED  #Used to watermark PDF pages and image batches in parallel
+from typing import NamedTuple       #Used to return results of batches
+from functools import partial, wraps #Used to pass options to batch items and to wrap instrumented methods
+import time                         #Used to time the stages of instrumented calls
+import inspect                      #Used to key cached results by all arguments of a call
+import contextlib                   #Used as the stage context when instrumentation is off
+import warnings                     #Used to report failing instruments without failing the call
+from collections import OrderedDict, deque #Used as LRU store of the overlay cache and queue of pages in flight
+import ctypes                       #Used to pass text and floats to pdfium
+import struct                       #Used to read image sizes from file headers
+import subprocess                   #Used to pipe raw frames and audio to ffmpeg
+import shutil                       #Used to copy TIFFs watermarked in tiles
+import stat                         #Used to check the owner and permissions of the speech clip folder
+import getpass                      #Used to name the per user speech clip folder where user ids are not available
+import queue                        #Used to hand PDF pages over to readers in other threads and processes
+
+
+class _LazyModule():
+    """
+    Stands in for a media backend module until it is used. The first attribute access imports the module
+    and replaces the stand-in in the globals of this module, so later accesses go to the module directly.
+    A backend which is not installed raises ImportError telling what it is needed for and how to install it.
+    """
+    def __init__(self, alias: str, name: str, media: str, install: str):
+        self._alias = alias
+        self._name = name
+        self._media = media
+        self._install = install
+
+    def _load(self):
+        try:
+            module = importlib.import_module(self._name)
+        except ImportError as e:
+            raise ImportError(f"{self._name} is needed to watermark {self._media}, install it with {self._install}") from e
+        globals()[self._alias] = module
+        return module
+
+    def __getattr__(self, attr: str):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        return f"<lazy module {self._name!r}>"
+
+# Media backends, imported on first use so that e.g. image only processes never load the others
+cv2 = _LazyModule("cv2", "cv2", "images, PDFs and videos", "pip install opencv-python")      #Used to create and merge watermark
+pdfium = _LazyModule("pdfium", "pypdfium2", "PDFs", "pip install watermar_king[pdf]")       #Used to extract pages from pdf files as images
+pdfium_c = _LazyModule("pdfium_c", "pypdfium2.raw", "PDFs", "pip install watermar_king[pdf]")  #Used to create watermark text objects in PDF pages
+imageio_ffmpeg = _LazyModule("imageio_ffmpeg", "imageio_ffmpeg", "videos and audios", "pip install watermar_king[video]")  #Used to run the bundled ffmpeg
+pyttsx3 = _LazyModule("pyttsx3", "pyttsx3", "audios", "pip install watermar_king[audio]")  #Used to create computer generated voice for watermarking audios
+
+# Backends needed per media type, see preload
+_backends = {"image": ("cv2",), "pdf": ("cv2", "pdfium", "pdfium_c"), "video": ("cv2", "imageio_ffmpeg"),
+             "audio": ("imageio_ffmpeg", "pyttsx3")}
+
+def preload(*media: str):
+    """
+    Imports the backends of the given media types (image, pdf, video, audio) now instead of on first use,
+    e.g. before forking workers or to fail at start up if one is not installed. Default loads all of them.
+    """
+    for kind in media or tuple(_backends):
+        if kind not in _backends:
+            raise ValueError(f"Unknown media type {kind!r}, use one of {', '.join(_backends)}")
+        for alias in _backends[kind]:
+            backend = globals()[alias]
+            if isinstance(backend, _LazyModule):
+                backend._load()
+
+# JPEG quality of rasterized PDF pages. Pages are encoded once from the rendered bitmap, 90 gives
+# better quality and smaller pages than the former JPEG 80 -> JPEG 95 round trip.
+_PDF_JPEG_QUALITY = 90
+
+# Render scale of PDF pages, pixels per point. Raster pages are written at this size in points
+# whatever the render scale, so the page size does not change with it.
+_PDF_SCALE = 2
+
+# Extensions passed to cv2.imencode per image format
+_imageExtensions = {"jpeg": ".jpg", "png": ".png", "tiff": ".tiff", "bmp": ".bmp"}
+_imageAliases = {"jpg": "jpeg", "tif": "tiff"}
+
+def _encoderParamNames() -> dict:
+    """
+    Returns the names accepted by WaterMarker.set_encoder_params per image format and the cv2 flags they stand for.
+    """
+    return {
+        "jpeg": {"quality": cv2.IMWRITE_JPEG_QUALITY, "progressive": cv2.IMWRITE_JPEG_PROGRESSIVE,
+                 "optimize": cv2.IMWRITE_JPEG_OPTIMIZE},
+        "png": {"compression": cv2.IMWRITE_PNG_COMPRESSION, "strategy": cv2.IMWRITE_PNG_STRATEGY},
+        "tiff": {"compression": cv2.IMWRITE_TIFF_COMPRESSION},
+        "bmp": {},
+    }
+
+def _imageSize(img: bytes) -> tuple:
+    """
+    Returns (width, height) of a JPEG, PNG, BMP or TIFF image read from its header, None if it can not be read.
+    """
+    try:
+        if img[:8] == b"\x89PNG\r\n\x1a\n":
+            return struct.unpack(">II", img[16:24])
+        if img[:2] == b"BM":
+            width, height = struct.unpack("<ii", img[18:26])
+            return width, abs(height)
+        if img[:3] == b"\xff\xd8\xff":
+            # walk the markers up to the first start of frame
+            pos = 2
+            while pos + 9 < len(img):
+                if img[pos] != 0xFF:
+                    return None
+                marker = img[pos + 1]
+                if marker == 0xFF:
+                    pos += 1
+                    continue
+                if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+                    pos += 2
+                    continue
+                length = struct.unpack(">H", img[pos + 2:pos + 4])[0]
+                if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                    height, width = struct.unpack(">HH", img[pos + 5:pos + 9])
+                    return width, height
+                pos += 2 + length
+            return None
+        if img[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+            order = "<" if img[:2] == b"II" else ">"
+            if img[2:4] in (b"*\x00", b"\x00*"):
+                ifd, countFormat, entrySize, valueOffset = struct.unpack(order + "I", img[4:8])[0], "H", 12, 8
+            else:
+                ifd, countFormat, entrySize, valueOffset = struct.unpack(order + "Q", img[8:16])[0], "Q", 20, 12
+            count = struct.unpack(order + countFormat, img[ifd:ifd + struct.calcsize(countFormat)])[0]
+            first = ifd + struct.calcsize(countFormat)
+            size = {}
+            for entry in range(count):
+                start = first + entry * entrySize
+                tag, kind = struct.unpack(order + "HH", img[start:start + 4])
+                if tag in (256, 257):
+                    value = img[start + valueOffset:start + valueOffset + 4]
+                    size[tag] = struct.unpack(order + ("H" if kind == 3 else "I"), value[:2 if kind == 3 else 4])[0]
+            if 256 in size and 257 in size:
+                return size[256], size[257]
+    except struct.error:
+        pass
+    return None
+
+def _pageCount(img: bytes) -> int:
+    """
+    Returns the number of pages of a TIFF or frames of an animated PNG read from its headers, 1 for other images.
+    """
+    try:
+        if img[:8] == b"\x89PNG\r\n\x1a\n":
+            # the animation control chunk comes before the image data
+            pos = 8
+            while pos + 8 <= len(img):
+                length, kind = struct.unpack(">I4s", img[pos:pos + 8])
+                if kind == b"acTL":
+                    return max(1, struct.unpack(">I", img[pos + 8:pos + 12])[0])
+                if kind == b"IDAT":
+                    break
+                pos += 12 + length
+        elif img[:4] in (b"II*\x00", b"MM\x00*", b"II+\x00", b"MM\x00+"):
+            order = "<" if img[:2] == b"II" else ">"
+            if img[2:4] in (b"*\x00", b"\x00*"):
+                ifd, countFormat, entrySize, nextFormat = struct.unpack(order + "I", img[4:8])[0], "H", 12, "I"
+            else:
+                ifd, countFormat, entrySize, nextFormat = struct.unpack(order + "Q", img[8:16])[0], "Q", 20, "Q"
+            countSize, nextSize = struct.calcsize(countFormat), struct.calcsize(nextFormat)
+            seen = set()
+            # follow the chain of image file directories, guarding against loops
+            while 0 < ifd < len(img) and ifd not in seen:
+                seen.add(ifd)
+                entries = struct.unpack(order + countFormat, img[ifd:ifd + countSize])[0]
+                pos = ifd + countSize + entries * entrySize
+                ifd = struct.unpack(order + nextFormat, img[pos:pos + nextSize])[0]
+            return max(1, len(seen))
+    except struct.error:
+        pass
+    return 1
+
+# Integer field types of TIFF tags: BYTE, SHORT, LONG, IFD, LONG8 and IFD8 of BigTIFF
+_tiffTypes = {1: "B", 3: "H", 4: "I", 13: "I", 16: "Q", 18: "Q"}
+
+class _tiffLayout(NamedTuple):
+    """
+    Pixel layout of the first image of an uncompressed TIFF. chunks are the strips or tiles as
+    (file offset, y, x, rows, columns) of their buffers, depth the samples per pixel of a buffer and
+    colour the leading samples which are watermarked (3 for RGB, 1 for grayscale).
+    """
+    width: int
+    height: int
+    depth: int
+    colour: int
+    chunks: list
+
+def _readTiffLayout(file) -> "_tiffLayout":
+    """
+    Reads the layout of the strips or tiles of the first image of a classic or BigTIFF file.
+    Raises ValueError for TIFFs whose pixels can not be watermarked in place: compressed, not 8 bit,
+    palette or YCbCr colours, or rotated by their orientation.
+    """
+    head = file.read(16)
+    if head[:2] not in (b"II", b"MM"):
+        raise ValueError("Not a TIFF file")
+    order = "<" if head[:2] == b"II" else ">"
+    version = struct.unpack(order + "H", head[2:4])[0]
+    if version == 42:
+        ifd, countFormat, entryFormat, inline = struct.unpack(order + "I", head[4:8])[0], "H", "HHI", 4
+    elif version == 43:
+        ifd, countFormat, entryFormat, inline = struct.unpack(order + "Q", head[8:16])[0], "Q", "HHQ", 8
+    else:
+        raise ValueError("Not a TIFF file")
+
+    file.seek(ifd)
+    countSize = struct.calcsize(order + countFormat)
+    entries = struct.unpack(order + countFormat, file.read(countSize))[0]
+    entrySize = struct.calcsize(order + entryFormat) + inline
+    table = file.read(entries * entrySize)
+    tags = {}
+    for entry in range(entries):
+        field = table[entry * entrySize:(entry + 1) * entrySize]
+        tag, kind, count = struct.unpack(order + entryFormat, field[:-inline])
+        code = _tiffTypes.get(kind)
+        if code is None:
+            continue
+        size = struct.calcsize(order + code) * count
+        value = field[-inline:]
+        if size > inline:
+            file.seek(struct.unpack(order + ("I" if inline == 4 else "Q"), value)[0])
+            value = file.read(size)
+        tags[tag] = struct.unpack(f"{order}{count}{code}", value[:size])
+
+    width, height = tags[256][0], tags[257][0]
+    samples = tags.get(277, (1,))[0]
+    photometric = tags.get(262, (None,))[0]
+    planar = tags.get(284, (1,))[0]
+    if tags.get(259, (1,))[0] != 1:
+        raise ValueError("Only uncompressed TIFFs can be watermarked in tiles")
+    if any(bits != 8 for bits in tags.get(258, (1,))):
+        raise ValueError("Only TIFFs of 8 bits per sample can be watermarked in tiles")
+    if photometric not in (1, 2):
+        raise ValueError("Only grayscale and RGB TIFFs can be watermarked in tiles")
+    if tags.get(274, (1,))[0] != 1:
+        raise ValueError("Only TIFFs without rotating orientation can be watermarked in tiles")
+    colour = 3 if photometric == 2 else 1
+    if samples < colour:
+        raise ValueError("TIFF has fewer samples per pixel than its colours")
+    # separate planes have the chunks of every sample one after another, each colour plane is watermarked alone
+    depth, planes = samples, 1
+    if planar != 1:
+        depth, planes, colour = 1, colour, 1
+
+    if 322 in tags:
+        tileWidth, tileHeight = tags[322][0], tags[323][0]
+        offsets, counts = tags[324], tags[325]
+        across, down = -(-width // tileWidth), -(-height // tileHeight)
+        places = [(row * tileHeight, column * tileWidth, tileHeight, tileWidth) for row in range(down) for column in range(across)]
+    else:
+        rowsPerStrip = min(tags.get(278, (height,))[0], height)
+        offsets, counts = tags[273], tags[279]
+        places = [(y, 0, min(rowsPerStrip, height - y), width) for y in range(0, height, rowsPerStrip)]
+
+    chunks = []
+    for index in range(min(len(offsets), len(places) * planes)):
+        y, x, rows, columns = places[index % len(places)]
+        if counts[index] < rows * columns * depth:
+            raise ValueError("TIFF strip or tile is shorter than its pixels")
+        chunks.append((offsets[index], y, x, rows, columns))
+    return _tiffLayout(width, height, depth, colour, chunks)
+
+class _videoFormat(NamedTuple):
+    """
+    Encoding of a video output format: ffmpeg muxer, video codec and its options, audio codecs which the
+    container takes as they are and the audio codec used for any other audio.
+    """
+    muxer: str
+    codec: str
+    options: list
+    audioCopy: tuple
+    audioCodec: str
+
+_videoFormats = {
+    "mp4": _videoFormat("mp4", "libx264", ["-pix_fmt", "yuv420p", "-crf", "23"], ("aac", "mp3", "ac3", "eac3", "alac", "opus"), "aac"),
+    "avi": _videoFormat("avi", "rawvideo", ["-pix_fmt", "yuv420p"], ("mp3", "aac", "ac3", "pcm_s16le", "pcm_u8"), "libmp3lame"),
+    "ogv": _videoFormat("ogg", "libtheora", ["-pix_fmt", "yuv420p", "-q:v", "7"], ("vorbis", "opus", "flac"), "libvorbis"),
+    "webm": _videoFormat("webm", "libvpx", ["-pix_fmt", "yuv420p", "-crf", "10", "-b:v", "1M", "-deadline", "good", "-cpu-used", "4"], ("vorbis", "opus"), "libvorbis"),
+}
+
+def _videoMeta(path: str) -> dict:
+    """
+    Returns the meta data imageio-ffmpeg reads for the video file path (size, fps, audio_codec, ...).
+    """
+    frames = imageio_ffmpeg.read_frames(path)
+    try:
+        return next(frames)
+    finally:
+        frames.close()
+
+def _audioArgs(source: str, meta: dict, format: _videoFormat) -> list:
+    """
+    Returns the ffmpeg arguments adding the first audio stream of source, as second input, to the video
+    of the first input. The audio is copied when format takes its codec and encoded otherwise.
+    """
+    # ffmpeg logs e.g. "vorbis," so the codec name may carry a comma
+    audioCodec = (meta.get("audio_codec") or "").rstrip(",")
+    if not audioCodec:
+        return []
+    return ["-i", source, "-map", "0:v:0", "-map", "1:a:0", "-c:a", "copy" if audioCodec in format.audioCopy else format.audioCodec]
+
+def _runFfmpeg(args: list, input: bytes=None) -> bytes:
+    """
+    Runs the ffmpeg of imageio-ffmpeg with args, raising RuntimeError with its log if it fails.
+
+    :param input: Bytes piped to ffmpeg as pipe:0. The output ffmpeg writes to pipe:1 is returned.
+    """
+    result = subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error"] + args,
+                            input=input, stdin=subprocess.DEVNULL if input is None else None,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError("ffmpeg failed: " + result.stderr.decode(errors="replace").strip())
+    return result.stdout
+
+# ffmpeg encoders of the compressed audio formats, wav is written directly
+_audioCodecs = {"ogg": "libvorbis", "mp3": "libmp3lame"}
+
+class _sampleFormat(NamedTuple):
+    """
+    Sample format of wav audios, kept when they are watermarked. The samples are decoded by ffmpeg with
+    codec into an array of dtype, 8 and 24 bit ones widened to the next type numpy has, and the 16 bit
+    spoken clips are multiplied by scale to be mixed into them. bits and tag (1 PCM, 3 float) go into
+    the wav header.
+    """
+    codec: str
+    dtype: str
+    scale: float
+    bits: int
+    tag: int
+
+_sampleFormats = {
+    "u8": _sampleFormat("pcm_s16le", "<i2", 1, 8, 1),
+    "s16": _sampleFormat("pcm_s16le", "<i2", 1, 16, 1),
+    "s24": _sampleFormat("pcm_s32le", "<i4", 65536, 24, 1),
+    "s32": _sampleFormat("pcm_s32le", "<i4", 65536, 32, 1),
+    "f32": _sampleFormat("pcm_f32le", "<f4", 1 / 32768, 32, 3),
+    "f64": _sampleFormat("pcm_f64le", "<f8", 1 / 32768, 64, 3),
+}
+
+def _wavSampleFormat(head: bytes) -> str:
+    """
+    Returns the key of _sampleFormats of the wav audio starting with head, "s16" for other audios and
+    sample formats which are not kept.
+    """
+    if head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        return "s16"
+    pos = 12
+    while pos + 8 <= len(head):
+        name, size = head[pos:pos + 4], struct.unpack("<I", head[pos + 4:pos + 8])[0]
+        if name == b"fmt " and size >= 16 and pos + 24 <= len(head):
+            tag, bits = struct.unpack("<H", head[pos + 8:pos + 10])[0], struct.unpack("<H", head[pos + 22:pos + 24])[0]
+            if tag == 0xFFFE and size >= 26 and pos + 34 <= len(head):
+                # extensible format, the actual tag starts its sub format
+                tag = struct.unpack("<H", head[pos + 32:pos + 34])[0]
+            if tag == 1:
+                return {8: "u8", 24: "s24", 32: "s32"}.get(bits, "s16")
+            if tag == 3:
+                return {32: "f32", 64: "f64"}.get(bits, "s16")
+            return "s16"
+        pos += 8 + size + (size & 1)
+    return "s16"
+
+def _readWavHeader(stream) -> tuple:
+    """
+    Reads the header of a PCM or float wav from stream up to the start of its samples and returns
+    (sample rate, channels). The sizes in the header are ignored, as ffmpeg can not fill them in
+    when it writes to a pipe.
+    """
+    head = stream.read(12)
+    if len(head) < 12 or head[:4] != b"RIFF" or head[8:12] != b"WAVE":
+        raise ValueError("ffmpeg did not return a wav stream")
+    rate = channels = None
+    while True:
+        chunk = stream.read(8)
+        if len(chunk) < 8:
+            raise ValueError("wav stream has no samples")
+        name, size = chunk[:4], struct.unpack("<I", chunk[4:])[0]
+        if name == b"data":
+            if rate is None:
+                raise ValueError("wav stream has no format")
+            return rate, channels
+        body = stream.read(size + (size & 1))
+        if name == b"fmt ":
+            channels, rate = struct.unpack("<HI", body[2:8])
+
+def _decodeAudio(data: bytes, rate: int=None, channels: int=None, sample: str="s16") -> tuple:
+    """
+    Decodes audio of any format ffmpeg reads through pipes and returns (samples, sample rate), samples
+    being an array of shape (frames, channels) of the dtype of _sampleFormats[sample], int16 by default.
+
+    :param rate: Sample rate to convert to, default keeps the one of data.
+    :param channels: Number of channels to convert to, default keeps the one of data.
+    """
+    format = _sampleFormats[sample]
+    args = ["-i", "pipe:0"]
+    if rate:
+        args += ["-ar", str(rate)]
+    if channels:
+        args += ["-ac", str(channels)]
+    stream = BytesIO(_runFfmpeg(args + ["-c:a", format.codec, "-f", "wav", "pipe:1"], data))
+    rate, channels = _readWavHeader(stream)
+    samples = np.frombuffer(stream.getbuffer()[stream.tell():], dtype=format.dtype)
+    # copied, as the samples are mixed in place
+    return samples[:len(samples) - len(samples) % channels].reshape(-1, channels).copy(), rate
+
+def _resample(samples, rate: int, to_rate: int):
+    """
+    Returns samples (frames, channels) converted from rate to to_rate by linear interpolation.
+    """
+    if rate == to_rate or not len(samples):
+        return samples
+    frames = max(1, round(len(samples) * to_rate / rate))
+    positions = np.arange(frames) * (rate / to_rate)
+    original = np.arange(len(samples))
+    return np.stack([np.interp(positions, original, samples[:, channel]) for channel in range(samples.shape[1])], axis=1)
+
+def _mixRepeated(samples, clip, period: int, offset: int=0):
+    """
+    Adds clip into samples (frames, channels) in place at every period frames from the start of the
+    audio, saturating at the range of integer samples. A clip longer than period is cut to it.
+
+    :param offset: Position of samples[0] in the audio in frames, for audios mixed in chunks.
+    """
+    clip = clip[:period]
+
+    def mix(region, clip):
+        if region.dtype.kind == "f":
+            region += clip
+            return
+        mixed = np.add(region, clip, dtype=np.int32 if region.dtype.itemsize == 2 else np.int64)
+        limits = np.iinfo(region.dtype)
+        np.clip(mixed, limits.min, limits.max, out=mixed)
+        region[...] = mixed
+
+    # rest of the clip started before samples
+    inClip = offset % period
+    if inClip:
+        head = period - inClip
+        if inClip < len(clip):
+            region = samples[:min(head, len(clip) - inClip)]
+            mix(region, clip[inClip:inClip + len(region)])
+        samples = samples[head:]
+
+    # the whole periods as one (repeats, period, channels) view, so all repeats are added at once
+    repeats = len(samples) // period
+    if repeats:
+        mix(samples[:repeats * period].reshape(repeats, period, -1)[:, :len(clip)], clip)
+    tail = samples[repeats * period:]
+    if len(tail):
+        mix(tail[:len(clip)], clip[:len(tail)])
+
+def _wavHeader(rate: int, channels: int, size: int=0xFFFFFFFF - 36, sample: str="s16") -> bytes:
+    """
+    Returns the header of a wav of the sample format sample (16 bit PCM by default) with size bytes
+    of samples. The default size marks a stream of unknown length, as written by ffmpeg to pipes.
+    """
+    format = _sampleFormats[sample]
+    width = format.bits // 8
+    return (b"RIFF" + struct.pack("<I", min(size + 36, 0xFFFFFFFF)) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, format.tag, channels, rate, rate * channels * width, channels * width, format.bits)
+            + b"data" + struct.pack("<I", min(size, 0xFFFFFFFF)))
+
+def _wavData(samples, sample: str="s16") -> bytes:
+    """
+    Returns samples decoded by _decodeAudio for sample as the sample data of a wav of that sample format.
+    """
+    if sample == "u8":
+        # 8 bit wavs are unsigned
+        return ((samples >> 8) + 128).astype(np.uint8).tobytes()
+    if sample == "s24":
+        # the top three bytes of the little endian int32 samples
+        return np.ascontiguousarray(samples, dtype="<i4").view(np.uint8).reshape(-1, 4)[:, 1:].tobytes()
+    return samples.astype(_sampleFormats[sample].dtype, copy=False).tobytes()
+
+class _ffmpegProcess():
+    """
+    ffmpeg of imageio-ffmpeg running with args, its log drained in a thread so it never blocks on a
+    full pipe. finish() waits for it and raises RuntimeError with the log if it failed.
+    """
+    def __init__(self, args: list, stdin=subprocess.PIPE, stdout=subprocess.PIPE):
+        self.process = subprocess.Popen([imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error"] + args,
+                                        stdin=stdin, stdout=stdout, stderr=subprocess.PIPE)
+        self._log = []
+        self._logReader = threading.Thread(target=lambda: self._log.append(self.process.stderr.read()), daemon=True)
+        self._logReader.start()
+
+    def finish(self, what: str):
+        self.process.wait()
+        self._logReader.join()
+        if self.process.returncode != 0:
+            raise RuntimeError(f"ffmpeg could not {what}: " + b"".join(self._log).decode(errors="replace").strip())
+
+    def kill(self):
+        # stops a process still running after an error
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class _pump(threading.Thread):
+    """
+    Thread copying the chunks returned by read to write until read returns nothing, then calling close
+    if given. An exception raised while copying is raised again by join.
+    """
+    def __init__(self, read, write, close=None):
+        super().__init__(daemon=True)
+        self.read, self.write, self.close = read, write, close
+        self.error = None
+        self.start()
+
+    def run(self):
+        try:
+            while True:
+                chunk = self.read(1 << 16)
+                if not chunk:
+                    break
+                self.write(chunk)
+        except BrokenPipeError:
+            # the ffmpeg on the other side stopped, the reason is in its log
+            pass
+        except BaseException as e:
+            self.error = e
+        finally:
+            if self.close is not None:
+                try:
+                    self.close()
+                except OSError:
+                    pass
+
+    def join(self):
+        super().join()
+        if self.error is not None:
+            raise self.error
+
+def _encodeAudio(samples, rate: int, format: str, sample: str="s16") -> bytes:
+    """
+    Encodes samples (frames, channels) decoded by _decodeAudio for sample to format (wav, ogg or mp3).
+    wav is written in the sample format sample, the compressed formats are encoded from int16 samples
+    by ffmpeg.
+    """
+    if format == "wav":
+        data = _wavData(samples, sample)
+        return _wavHeader(rate, samples.shape[1], len(data), sample) + data
+    return _runFfmpeg(["-f", "s16le", "-ar", str(rate), "-ac", str(samples.shape[1]), "-i", "pipe:0",
+                       "-c:a", _audioCodecs[format], "-f", format, "pipe:1"], samples.astype("<i2", copy=False).tobytes())
+
+# Number of leading bytes WaterMarker.detect_format looks at
+_sniffLength = 1024
+
+class _handler(NamedTuple):
+    """
+    Format handler registered with WaterMarker.register_handler.
+    """
+    function: object
+    signatures: tuple
+    media: str
+
+
+class WaterMarkCancelled(Exception):
+    """
+    Raised inside a watermarking call which was cancelled by its caller, e.g. by AsyncWaterMarker.
+    """
+
+
+# Cancellation token of the call running in the current thread. Set by AsyncWaterMarker, the token
+# only needs an is_set() method so threading.Event and multiprocessing manager events both work.
+_callState = threading.local()
+
+def _checkCancelled():
+    """
+    Raises WaterMarkCancelled if the call running in this thread has been cancelled.
+    Called between pages, frames and processing stages.
+    """
+    token = getattr(_callState, "cancel", None)
+    if token is not None and token.is_set():
+        raise WaterMarkCancelled()
+
+# Stage context of calls which are not instrumented, reused as it does nothing
+_noStage = contextlib.nullcontext()
+
+class _stageTimer():
+    """
+    Context adding the time spent in it to the stage name of an instrumented call.
+    """
+    __slots__ = ("stages", "name", "start")
+
+    def __init__(self, stages: dict, name: str):
+        self.stages = stages
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.stages[self.name] = self.stages.get(self.name, 0.0) + time.perf_counter() - self.start
+
+def _stage(name: str):
+    """
+    Returns the context timing stage name (decode, render, overlay, blend, encode, temp_io, ...) of the
+    instrumented call running in this thread, or a context doing nothing when there is none.
+    """
+    record = getattr(_callState, "metrics", None)
+    return _noStage if record is None else _stageTimer(record["stages"], name)
+
+def _count(name: str, count: int=1):
+    """
+    Adds count to the counter name (pages, frames, samples, ...) of the instrumented call running in this thread.
+    """
+    record = getattr(_callState, "metrics", None)
+    if record is not None:
+        counts = record["counts"]
+        counts[name] = counts.get(name, 0) + count
+
+def _putWaiting(itemQueue, item):
+    """
+    Puts item on itemQueue, waiting while it is full unless the current call is cancelled.
+    """
+    while True:
+        try:
+            itemQueue.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            _checkCancelled()
+
+def _timed(items, name: str):
+    """
+    Yields items, adding the time spent waiting for each of them to stage name.
+    """
+    items = iter(items)
+    end = object()
+    while True:
+        with _stage(name):
+            item = next(items, end)
+        if item is end:
+            return
+        yield item
+
+def _instrumented(method):
+    """
+    Decorator of the public WaterMarker methods. When the WaterMarker has an instrument, a call records its
+    stage timings and counts and passes them to the instrument as a dict:
+
+    {"method": name, "seconds": total, "stages": {stage: seconds}, "counts": {name: count}, "error": None or exception name}
+
+    Calls made by an instrumented call (e.g. WaterMark calling WaterMark_PNG) are part of its record.
+    """
+    name = method.__name__
+
+    @wraps(method)
+    def call(self, *args, **kwargs):
+        if self.instrument is None or getattr(_callState, "metrics", None) is not None:
+            return method(self, *args, **kwargs)
+        record = {"method": name, "seconds": 0.0, "stages": {}, "counts": {}, "error": None}
+        if args and isinstance(args[0], (bytes, bytearray, memoryview)):
+            record["counts"]["bytes_in"] = len(args[0])
+        _callState.metrics = record
+        start = time.perf_counter()
+        try:
+            result = method(self, *args, **kwargs)
+            if isinstance(result, BytesIO):
+                with result.getbuffer() as view:
+                    record["counts"]["bytes_out"] = view.nbytes
+            return result
+        except BaseException as e:
+            record["error"] = type(e).__name__
+            raise
+        finally:
+            record["seconds"] = time.perf_counter() - start
+            _callState.metrics = None
+            try:
+                self.instrument(record)
+            except Exception as e:
+                warnings.warn(f"Instrument of WaterMarker failed: {e!r}", RuntimeWarning)
+    return call
+
+# Arguments which only change how a call runs, not its output, left out of the result cache key
+_executionArguments = ("workers", "window")
+
+def _cached(method):
+    """
+    Decorator of the public WaterMarker methods taking the input as bytes. When the WaterMarker has a
+    result_cache, the output is fetched from it by the content address of the input, the text, all other
+    arguments (defaults included) except the _executionArguments and the encoder parameters, and only
+    computed on a miss. Calls writing to an out stream and calls made by a cached call are not cached.
+    """
+    name = method.__name__
+    signature = inspect.signature(method)
+
+    @wraps(method)
+    def call(self, *args, **kwargs):
+        cache = self.result_cache
+        if cache is None or getattr(_callState, "caching", False):
+            return method(self, *args, **kwargs)
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        arguments = {}
+        for parameter, value in list(bound.arguments.items())[1:]:
+            if signature.parameters[parameter].kind is inspect.Parameter.VAR_KEYWORD:
+                arguments.update(value)
+            else:
+                arguments[parameter] = value
+        data = arguments.pop(next(iter(arguments)))
+        for parameter in _executionArguments:
+            arguments.pop(parameter, None)
+        if not isinstance(data, (bytes, bytearray, memoryview)) or arguments.get("out") is not None:
+            return method(self, *args, **kwargs)
+
+        result = None
+        def compute():
+            nonlocal result
+            _callState.caching = True
+            try:
+                result = method(self, *args, **kwargs)
+            finally:
+                _callState.caching = False
+            # outputs which could not be encoded are the input itself, those are not kept
+            return result.getvalue() if isinstance(result, BytesIO) else None
+        value = cache.fetch(cache.key(data, name, arguments, self.encoder_params), compute)
+        if result is not None:
+            return result
+        _count("cache_hits")
+        return BytesIO(value)
+    return call
+
+def _removeFiles(*paths):
+    """
+    Removes the given temporary files, ignoring the ones which do not exist.
+    """
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+# Bytes written to temporary files on disk, in total and by the last call of each thread
+_tempUsage = {"calls": 0, "bytes": 0}
+_tempUsageLock = threading.Lock()
+
+def _addTempBytes(count: int):
+    _callState.tempBytes = getattr(_callState, "tempBytes", 0) + count
+
+class _tempAccounting():
+    """
+    Context of a public video or audio call, counting the bytes it writes to temporary files on disk.
+    """
+    def __enter__(self):
+        _callState.tempBytes = 0
+
+    def __exit__(self, *exc):
+        with _tempUsageLock:
+            _tempUsage["calls"] += 1
+            _tempUsage["bytes"] += _callState.tempBytes
+
+class _scratchFile():
+    """
+    Seekable file with a path, for ffmpeg and the speech engine which can not work on pipes alone.
+
+    On Linux it is a memory backed memfd reached through /proc/<pid>/fd/<fd>, so nothing touches the
+    disk. Elsewhere it is a temporary file which is removed on close and whose bytes are counted as
+    temporary bytes of the call.
+    """
+    def __init__(self, data: bytes=None, suffix: str=""):
+        if hasattr(os, "memfd_create"):
+            self.fd = os.memfd_create("watermar_king")
+            self.path = f"/proc/{os.getpid()}/fd/{self.fd}"
+            self.onDisk = False
+        else:
+            self.fd, self.path = tempfile.mkstemp(suffix=suffix, prefix="Arch_")
+            self.onDisk = True
+        try:
+            if data:
+                with _stage("temp_io"), memoryview(data) as view:
+                    while view:
+                        view = view[os.write(self.fd, view):]
+        except BaseException:
+            self.close()
+            raise
+
+    def read(self) -> bytes:
+        """
+        Returns the whole content, also when it has been written by another process through path.
+        """
+        with _stage("temp_io"):
+            os.lseek(self.fd, 0, os.SEEK_SET)
+            chunks = []
+            while True:
+                chunk = os.read(self.fd, 1 << 20)
+                if not chunk:
+                    return b"".join(chunks)
+                chunks.append(chunk)
+
+    def close(self):
+        if self.fd is None:
+            return
+        if self.onDisk:
+            _addTempBytes(os.fstat(self.fd).st_size)
+        os.close(self.fd)
+        self.fd = None
+        if self.onDisk:
+            _removeFiles(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
 class _waterMark():
     """
@@ -57,21 +866,569 @@ class _waterMark():
         # get size of text
         textsize = cv2.getTextSize(text = text_to_write, fontFace = self.font, fontScale = self.font_size, thickness = self.thickness)[0]
         # adjust text size if it is too big
-        while textsize[0] > self.image_width:
-            self.font_size -= 0.1
+        if textsize[0] > self.image_width:
+            self.font_size = self._fitFontSize()
             textsize = cv2.getTextSize(text = text_to_write, fontFace = self.font, fontScale = self.font_size, thickness = self.thickness)[0]
         
         # set X position of the text
         self.textX = (self.image_width - textsize[0]) // 2
+
+    def _fitFontSize(self) -> float:
+        """
+        Returns the largest of the font sizes font_size, font_size - 0.1, font_size - 0.2, ... at which
+        the text fits into the image width.
+
+        The sizes are built by repeated subtraction of 0.1, exactly as a step by step shrinking loop
+        would, so the result is identical to it. As the text width shrinks with the font size, the
+        first fitting step is found by galloping and binary search, taking a handful of getTextSize
+        calls instead of one per step. Only positive sizes are tried; text which does not fit even at
+        the smallest of them, e.g. on an image of a few pixels width, gets the smallest one.
+        """
+        sizes = [self.font_size]
+        while sizes[-1] - 0.1 > 0:
+            sizes.append(sizes[-1] - 0.1)
+        last = len(sizes) - 1
+        def size(step: int) -> float:
+            return sizes[step]
+        def fits(step: int) -> bool:
+            width = cv2.getTextSize(text = self.text_to_write, fontFace = self.font, fontScale = size(step), thickness = self.thickness)[0][0]
+            return width <= self.image_width
+
+        # step low is known not to fit, gallop until step high fits
+        low, high = 0, min(1, last)
+        while not fits(high):
+            if high == last:
+                return size(last)
+            low, high = high, min(high * 2, last)
+        # then narrow down to the first fitting step
+        while high - low > 1:
+            middle = (low + high) // 2
+            if fits(middle):
+                high = middle
+            else:
+                low = middle
+        return size(high)
         
 
+class _overlayBands():
+    """
+    Watermark overlay of an image size, kept as the text bands only. Everything outside the bands
+    is white (255). bands is a list of (y0, y1, x0, x1, strip) boxes, disjoint in y and sorted from
+    top to bottom, strip holding the overlay pixels of the box.
+    """
+    def __init__(self, shape: tuple, bands: list):
+        self.shape = shape
+        self.bands = bands
+        self.nbytes = sum(band[4].nbytes for band in bands)
+
+    def setflags(self, write: bool):
+        for band in self.bands:
+            band[4].setflags(write=write)
+
+
+# Blend of the pixels outside the text bands, set up on first use by _getOutsideBandsBlend
+_outsideBandsBlend = None
+
+def _getOutsideBandsBlend():
+    """
+    Returns a function(src, dst) writing addWeighted(src, 0.7, 255, 0.3, 0.5) into dst, i.e. the blend outside
+    the text bands, which only depends on the pixel value.
+
+    The mapping is a 256 entry lookup table computed with cv2.addWeighted itself over a long row, so its
+    rounding is exactly the one of the full blend. cv2.convertScaleAbs(alpha=0.7, beta=77) is faster than
+    cv2.LUT and is used instead when it gives the very same table.
+    """
+    global _outsideBandsBlend
+    if _outsideBandsBlend is None:
+        values = np.tile(np.arange(256, dtype=np.uint8), 16).reshape(1, -1)
+        table = cv2.addWeighted(values, 0.7, np.full_like(values, 255), 0.3, 0.5)
+        if np.array_equal(cv2.convertScaleAbs(values, alpha=0.7, beta=77.0), table):
+            _outsideBandsBlend = lambda src, dst: cv2.convertScaleAbs(src, dst=dst, alpha=0.7, beta=77.0)
+        else:
+            lut = np.ascontiguousarray(table[:, :256])
+            _outsideBandsBlend = lambda src, dst: cv2.LUT(src, lut, dst=dst)
+    return _outsideBandsBlend
+
+def _blendBands(src, overlay: "_overlayBands", dst):
+    """
+    Writes addWeighted(src, 0.7, overlay, 0.3, 0.5) into dst, which may be src itself, see WaterMarker._blendWaterMark.
+    """
+    outside = _getOutsideBandsBlend()
+    width = src.shape[1]
+    previous = 0
+    for y0, y1, x0, x1, strip in overlay.bands:
+        if y0 > previous:
+            outside(src[previous:y0], dst[previous:y0])
+        if x0 > 0:
+            outside(src[y0:y1, :x0], dst[y0:y1, :x0])
+        cv2.addWeighted(src1=src[y0:y1, x0:x1], alpha=0.7, src2=strip, beta=0.3, gamma=0.5, dst=dst[y0:y1, x0:x1])
+        if x1 < width:
+            outside(src[y0:y1, x1:], dst[y0:y1, x1:])
+        previous = y1
+    if previous < src.shape[0]:
+        outside(src[previous:], dst[previous:])
+    return dst
+
+def _cropBands(overlay: "_overlayBands", y: int, x: int, height: int, width: int) -> "_overlayBands":
+    """
+    Returns the bands of overlay within the box of height x width at (y, x), relative to that box.
+    The strips are views of the ones of overlay.
+    """
+    bands = []
+    for y0, y1, x0, x1, strip in overlay.bands:
+        top, bottom, left, right = max(y0, y), min(y1, y + height), max(x0, x), min(x1, x + width)
+        if top < bottom and left < right:
+            bands.append((top - y, bottom - y, left - x, right - x, strip[top - y0:bottom - y0, left - x0:right - x0]))
+    return _overlayBands((height, width) + tuple(overlay.shape[2:]), bands)
+
+def _textExtent(text_to_write: str, wm: "_waterMark") -> tuple:
+    """
+    Returns the box (x0, y0, x1, y1) covered by the pixels of text_to_write drawn with the font of wm,
+    relative to the text origin. Measured by drawing the text, as glyphs reach beyond cv2.getTextSize.
+    """
+    (width, height), baseline = cv2.getTextSize(text_to_write, wm.font, wm.font_size, wm.thickness)
+    pad = height + baseline + 2 * wm.thickness + 2
+    while True:
+        canvas = np.zeros((height + baseline + 2 * pad, width + 2 * pad), dtype=np.uint8)
+        cv2.putText(canvas, text=text_to_write, org=(pad, pad + height), fontFace=wm.font, fontScale=wm.font_size, color=255, thickness=wm.thickness, lineType=cv2.LINE_8)
+        ys, xs = np.nonzero(canvas)
+        if len(ys) == 0:
+            return (0, 0, 0, 0)
+        # grow the canvas if the text touches its border, the extent may be cut off
+        if ys.min() > 0 and xs.min() > 0 and ys.max() < canvas.shape[0] - 1 and xs.max() < canvas.shape[1] - 1:
+            return (int(xs.min()) - pad, int(ys.min()) - pad - height, int(xs.max()) + 1 - pad, int(ys.max()) + 1 - pad - height)
+        pad *= 2
+
+
+class OverlayCache():
+    """
+    Bounded LRU cache of watermark overlays keyed by (width, height, channels, text).
+
+    Building an overlay runs the font fitting, measures the text and draws it three times; for the
+    same page or photo size and the same text the result is always identical, so it is built once
+    and reused. The cache is limited by the total bytes held by
+    the overlays instead of the number of entries, least recently used overlays are evicted first.
+    Cached overlays are read-only and shared between threads.
+    """
+    def __init__(self, max_bytes: int=256 * 1024 * 1024):
+        """
+        :param max_bytes: Memory budget of the cache in bytes. 0 disables caching.
+        """
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: tuple, build):
+        """
+        Returns the overlay stored against key, calling build() to create it on a miss.
+
+        :param key: Hashable key identifying the overlay.
+        :param build: Callable returning the overlay, a numpy array or any object with nbytes and setflags().
+        """
+        with self._lock:
+            overlay = self._entries.get(key)
+            if overlay is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return overlay
+            self.misses += 1
+        # build outside the lock so other sizes are not blocked meanwhile
+        overlay = build()
+        overlay.setflags(write=False)
+        with self._lock:
+            if overlay.nbytes > self.max_bytes:
+                return overlay
+            if key in self._entries:
+                # built concurrently by another thread, keep the stored one
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self._entries[key] = overlay
+            self._bytes += overlay.nbytes
+            self._evict()
+        return overlay
+
+    def resize(self, max_bytes: int):
+        """
+        Changes the memory budget, evicting overlays if the cache is over the new budget.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Removes all overlays. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        """
+        Returns counters of the cache for monitoring.
+        """
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        # must be called with the lock held
+        while self._bytes > self.max_bytes and self._entries:
+            _, overlay = self._entries.popitem(last=False)
+            self._bytes -= overlay.nbytes
+            self.evictions += 1
+
+
+# Speech engine of the process, created on first use and used by one thread at a time
+_speechEngine = {}
+_speechLock = threading.Lock()
+
+def _synthesize(text_to_write: str, voice_index: int, rate, format: str) -> bytes:
+    """
+    Speaks text_to_write into an audio file of format (wav or mp3) and returns its bytes.
+    Must be called with _speechLock held.
+
+    :param rate: Words per minute, None uses 100 less than the default rate of the engine.
+    """
+    # a forked process can not use the engine of its parent
+    if _speechEngine.get("pid") != os.getpid():
+        engine = pyttsx3.init()
+        _speechEngine.update(pid=os.getpid(), engine=engine, rate=engine.getProperty('rate'))
+    engine = _speechEngine["engine"]
+    engine.setProperty('rate', _speechEngine["rate"]-100 if rate is None else rate)
+
+    # Uncomment the following lines to see all the available voices
+    #voices = engine.getProperty('voices') 
+    #for voice in voices: 
+    #    print(f'voice: {voice.name}')
+
+    # This function depends on the voices installed in the system and requires index of the installed voices; which may vary.
+    engine.setProperty('voice', voice_index)
+    # the engine only saves to a path, which is memory backed where available
+    with _scratchFile(suffix="."+format) as clip:
+        engine.save_to_file(text=text_to_write, filename=clip.path)
+        engine.runAndWait()
+        return clip.read()
+
+
+def _privateDirectory(directory: str) -> bool:
+    """
+    Creates directory readable by the current user only if it does not exist, and returns whether it is a
+    real folder owned by the current user which nobody else can write to, so files found in it can be trusted.
+    """
+    try:
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    if not stat.S_ISDIR(info.st_mode):
+        # a link planted in place of the folder
+        return False
+    if hasattr(os, "getuid"):
+        return info.st_uid == os.getuid() and not info.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+    # temporary folders are per user where user ids are not available (Windows)
+    return True
+
+def _userId() -> str:
+    return str(os.getuid()) if hasattr(os, "getuid") else getpass.getuser()
+
+class SpeechCache():
+    """
+    Content addressed cache of the spoken watermark clips of audios.
+
+    Synthesizing speech takes most of the time of watermarking an audio and gives the same clip for the
+    same text, voice, rate and format every time. Clips are stored against the sha256 of those, recently
+    used ones in memory up to max_bytes and as files in directory up to disk_bytes, so they outlive the
+    process and are shared by processes of the same user. Least recently used clips are evicted first
+    from both. Clips are synthesized by one engine per process, one at a time.
+
+    The directory is only used if it is owned by the current user and nobody else can write to it,
+    otherwise clips are kept in memory only.
+    """
+    def __init__(self, max_bytes: int=64 * 1024 * 1024, directory: str=None, disk_bytes: int=256 * 1024 * 1024):
+        """
+        :param max_bytes: Memory budget of the cache in bytes. 0 keeps clips on disk only.
+
+        :param directory: Folder of the clip files, created readable by the current user only if needed.
+            Default is watermar_king_speech-<user id> in the temporary folder of the system, "" keeps clips in
+            memory only.
+
+        :param disk_bytes: Disk budget of the clip files in directory in bytes.
+        """
+        self.max_bytes = max_bytes
+        self.disk_bytes = disk_bytes
+        self.directory = os.path.join(tempfile.gettempdir(), "watermar_king_speech-" + _userId()) if directory is None else directory
+        self._entries = OrderedDict()
+        self._bytes = 0
+        # index of the clip files, made on first use of the directory, None until then
+        self._files = None
+        self._fileBytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(text_to_write: str, voice_index: int=28, rate=None, format: str="wav") -> str:
+        """
+        Returns the content address of a clip.
+        """
+        return hashlib.sha256(repr((text_to_write, voice_index, rate, format)).encode()).hexdigest()
+
+    def get(self, text_to_write: str, voice_index: int=28, rate=None, format: str="wav") -> bytes:
+        """
+        Returns the clip of text_to_write spoken by voice_index at rate as an audio file of format
+        (wav or mp3), synthesizing it if it is not cached.
+
+        :param rate: Words per minute, None uses 100 less than the default rate of the engine.
+        """
+        key = self.key(text_to_write, voice_index, rate, format)
+        clip = self._lookup(key)
+        if clip is not None:
+            return clip
+        with _speechLock:
+            # synthesized by another thread meanwhile
+            clip = self._lookup(key, count=False)
+            if clip is None:
+                clip = _synthesize(text_to_write, voice_index, rate, format)
+                self._store(key, clip)
+                self._write(key, clip)
+        return clip
+
+    def warm(self, texts, voice_index: int=28, rate=None, formats=("wav", "mp3")):
+        """
+        Synthesizes the clips of texts ahead of time, e.g. at start up, for all formats. WAV and OGG
+        audios use wav clips, MP3 audios use mp3 clips.
+        """
+        for text_to_write in texts:
+            for format in formats:
+                self.get(text_to_write, voice_index, rate, format)
+
+    def resize(self, max_bytes: int, disk_bytes: int=None):
+        """
+        Changes the memory budget, and the disk budget if disk_bytes is given, evicting clips if the cache
+        is over the new budgets.
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+            if disk_bytes is not None:
+                self.disk_bytes = disk_bytes
+                self._evictFiles()
+
+    def clear(self, disk: bool=False):
+        """
+        Removes all clips from memory, and from directory if disk is True. Counters are kept.
+        """
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if disk and self._disk():
+                _removeFiles(*(entry.path for entry in os.scandir(self.directory) if entry.name.endswith(".clip")))
+                self._files.clear()
+                self._fileBytes = 0
+
+    def stats(self) -> dict:
+        """
+        Returns counters of the cache for monitoring. hits are served from memory, disk_hits from directory.
+        """
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "files": len(self._files or ()), "disk_bytes": self._fileBytes, "max_disk_bytes": self.disk_bytes}
+
+    def _lookup(self, key: str, count: bool=True) -> bytes:
+        with self._lock:
+            clip = self._entries.get(key)
+            if clip is not None:
+                self._entries.move_to_end(key)
+                self.hits += count
+                return clip
+        clip = self._read(key)
+        with self._lock:
+            if clip is not None:
+                self.disk_hits += 1
+            elif count:
+                self.misses += 1
+        if clip is not None:
+            self._store(key, clip)
+        return clip
+
+    def _store(self, key: str, clip: bytes):
+        with self._lock:
+            if len(clip) > self.max_bytes or key in self._entries:
+                return
+            self._entries[key] = clip
+            self._bytes += len(clip)
+            self._evict()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".clip")
+
+    def _disk(self) -> bool:
+        # must be called with the lock held, indexes the clip files on first use of a trusted directory
+        if self._files is None:
+            if not self.directory:
+                return False
+            if not _privateDirectory(self.directory):
+                warnings.warn("Speech clip folder %s is not private to the current user, clips are kept in memory only" % self.directory)
+                self.directory = ""
+                return False
+            self._files = OrderedDict()
+            # oldest first, clips written by other processes are counted against the budget from here on
+            files = [entry for entry in os.scandir(self.directory) if entry.name.endswith(".clip")]
+            for entry in sorted(files, key=lambda entry: entry.stat().st_mtime):
+                self._files[entry.name[:-5]] = entry.stat().st_size
+                self._fileBytes += entry.stat().st_size
+            self._evictFiles()
+        return True
+
+    def _read(self, key: str) -> bytes:
+        with self._lock:
+            if not self._disk():
+                return None
+        try:
+            with open(self._path(key), "rb") as file:
+                clip = file.read()
+            # modification time orders the files by use for the index of the next start
+            os.utime(self._path(key))
+        except OSError:
+            with self._lock:
+                self._fileBytes -= self._files.pop(key, 0)
+            return None
+        with self._lock:
+            self._fileBytes += len(clip) - self._files.pop(key, 0)
+            self._files[key] = len(clip)
+        return clip
+
+    def _write(self, key: str, clip: bytes):
+        with self._lock:
+            if not self._disk() or len(clip) > self.disk_bytes:
+                return
+        # written under another name and renamed, so readers never see a partial clip
+        try:
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix=".part")
+            with os.fdopen(fd, "wb") as file:
+                file.write(clip)
+            os.replace(path, self._path(key))
+        except OSError:
+            # the clip is still served from memory
+            return
+        with self._lock:
+            self._fileBytes += len(clip) - self._files.pop(key, 0)
+            self._files[key] = len(clip)
+            self._evictFiles()
+
+    def _evict(self):
+        # must be called with the lock held
+        while self._bytes > self.max_bytes and self._entries:
+            _, clip = self._entries.popitem(last=False)
+            self._bytes -= len(clip)
+            self.evictions += 1
+
+    def _evictFiles(self):
+        # must be called with the lock held
+        while self._files and self._fileBytes > self.disk_bytes:
+            key, size = self._files.popitem(last=False)
+            self._fileBytes -= size
+            self.evictions += 1
+            _removeFiles(self._path(key))
+
+
+class BatchResult(NamedTuple):
+    """
+    Result of one item of WaterMarker.WaterMark_Batch.
+
+    :index: Position of the item in the given iterable.
+    :output: The watermarked image as BytesIO, None if the item failed.
+    :error: The exception raised while watermarking the item, None on success.
+    """
+    index: int
+    output: BytesIO
+    error: Exception
+
 
 class WaterMarker():
     """ 
     Class to watermark images, PDFs, videos and audios 
     
+    Overlays are cached in overlay_cache and spoken clips of audios in speech_cache, which are
+    shared by all instances unless replaced with instance specific caches.
+
     """
-        
+
+    overlay_cache = OverlayCache()
+
+    # Spoken watermark clips of audios, shared by all instances like overlay_cache
+    speech_cache = SpeechCache()
+
+    # Optional ResultCache of the outputs of calls, shared by all instances like overlay_cache. Off by default
+    result_cache = None
+
+    # Registered format handlers of WaterMark, filled below the class
+    _handlers = OrderedDict()
+
+    def __init__(self, encoder_params: dict=None, instrument=None, result_cache=None):
+        """
+        :param encoder_params: Optional encoder parameters per image format, see set_encoder_params. Formats
+            which are not given are encoded with OpenCV defaults, PDF pages use the jpeg parameters if given.
+
+        :param instrument: Optional callable receiving the stage timings and counts of every call, e.g. a
+            MetricsCollector. See _instrumented for the record passed. Default None records nothing.
+
+        :param result_cache: Optional ResultCache serving repeated calls with the same input, text and
+            parameters from stored outputs, see _cached. Default None uses the result_cache of the class.
+
+        ::
+
+            wm = WaterMarker(encoder_params={"jpeg": {"quality": 85}, "png": {"compression": 9}})
+
+        """
+        self.instrument = instrument
+        if result_cache is not None:
+            self.result_cache = result_cache
+        self.encoder_params = {}
+        self._encoderFlags = {}
+        for format, params in (encoder_params or {}).items():
+            self.set_encoder_params(format, params)
+
+    def _getWaterMarkBands(self, shape: tuple, text_to_write: str) -> "_overlayBands":
+        """
+        :Private Function:
+
+        Returns the read-only watermark overlay for an image of shape from overlay_cache,
+        creating it with _buildWaterMarkBands on a miss.
+        """
+        key = (shape[1], shape[0], shape[2] if len(shape) > 2 else 1, text_to_write)
+        def build():
+            with _stage("overlay"):
+                return self._buildWaterMarkBands(shape, text_to_write)
+        return self.overlay_cache.get(key, build)
+
+    def _blendWaterMark(self, img, text_to_write: str, dst=None):
+        """
+        :Private Function:
+
+        Blends the watermark into img and returns dst, which defaults to img itself.
+
+        The result is exactly cv2.addWeighted(img, 0.7, overlay, 0.3, 0.5) with the overlay of
+        _getBlankWaterMarkImage. That overlay is white apart from the three text bands, so outside the
+        bounding boxes of the bands the blend only depends on the pixel value and is done with a 256
+        entry lookup table; the real blend only runs inside the boxes. No image sized temporary is created.
+
+        :param img: BGR image to be watermarked.
+        :param text_to_write: Text to be used as watermark.
+        :param dst: Optional array of the shape of img receiving the result.
+        """
+        overlay = self._getWaterMarkBands(img.shape, text_to_write)
+        with _stage("blend"):
+            return _blendBands(img, overlay, img if dst is None else dst)
+
     def _getBlankWaterMarkImage(self,img, text_to_write: str="Watermark this image"):
         
         """
@@ -80,49 +1437,207 @@ class WaterMarker():
         Creates a blank image with watermark text placed at specified intervals.
 
         This function generates a blank image of the same size as the input image, with the given
-        text written as a watermark across multiple lines at specified vertical positions.
+        text written as a watermark across multiple lines at specified vertical positions, from the
+        cached text bands of _getWaterMarkBands.
 
         :param img: The input image from which dimensions are derived for the blank watermark image.
         :param text_to_write: The watermark text to be placed on the blank image. Default is "Watermark this image".
         :return: A blank image with the watermark text applied, with colors inverted for visibility.
+        """
+        out = np.full(img.shape, 255, dtype=np.uint8)
+        for y0, y1, x0, x1, strip in self._getWaterMarkBands(img.shape, text_to_write).bands:
+            out[y0:y1, x0:x1] = strip
+        return out
+
+    def _buildWaterMarkBands(self, shape: tuple, text_to_write: str="Watermark this image") -> "_overlayBands":
+        
+        """
+        :Private Function:
+
+        Creates the text bands of the watermark overlay of an image of shape.
 
+        The text is written in three lines at 25%, 50% and 75% of the image height. Only the bounding
+        boxes of the drawn text are kept, each as the inverted (white background) overlay pixels of the box.
+
+        :param shape: Shape of the input image from which dimensions are derived for the watermark.
+        :param text_to_write: The watermark text to be placed on the overlay. Default is "Watermark this image".
         """
         #Get size of image
-        img_width, img_height = img.shape[1], img.shape[0]
+        img_width, img_height = shape[1], shape[0]
         
         wm=_waterMark(img_width, img_height, text_to_write)
+        dx0, dy0, dx1, dy1 = _textExtent(text_to_write, wm)
+
+        # bounding boxes of the three lines, clipped to the image
+        lines = []
+        for percent in (25, 50, 75):
+            num = int(img_height * percent/100)
+            box = (max(wm.textX + dx0, 0), max(num + dy0, 0), min(wm.textX + dx1, img_width), min(num + dy1, img_height))
+            if box[0] < box[2] and box[1] < box[3]:
+                lines.append((num, box))
+        # on small images lines may overlap, merge them into one band
+        groups = []
+        for num, box in lines:
+            if groups and box[1] < groups[-1][1][3]:
+                nums, (x0, y0, x1, y1) = groups[-1]
+                groups[-1] = (nums + [num], (min(x0, box[0]), y0, max(x1, box[2]), max(y1, box[3])))
+            else:
+                groups.append(([num], box))
+
+        # putText rasterizes glyphs cut by the canvas border differently, so every band is drawn on a canvas
+        # reaching pad pixels beyond its box, but not beyond the image, and cut back to the box
+        pad = wm.thickness + 2
+        bands = []
+        for nums, (x0, y0, x1, y1) in groups:
+            cx0, cy0, cx1, cy1 = max(x0 - pad, 0), max(y0 - pad, 0), min(x1 + pad, img_width), min(y1 + pad, img_height)
+            blank = np.zeros(shape=(cy1 - cy0, cx1 - cx0) + tuple(shape[2:]), dtype=np.uint8)
+            for num in nums:
+                text_location=(wm.textX - cx0, num - cy0)
+                cv2.putText(blank, text=text_to_write, org = text_location, fontFace = wm.font, fontScale = wm.font_size, color=(200, 200, 200), thickness=wm.thickness, lineType=cv2.LINE_8)
+            blank = np.ascontiguousarray(blank[y0 - cy0:y1 - cy0, x0 - cx0:x1 - cx0])
+            # Convert 0s to 1s and 1s to 0s to invert colors black and white for readability
+            cv2.bitwise_not(blank, dst=blank)
+            bands.append((y0, y1, x0, x1, blank))
+        return _overlayBands(tuple(shape), bands)
+   
+    # Shared body of the image methods, decodes, blends and encodes with the parameters set for format
+    def _waterMarkImage(self, img: bytes, text_to_write: str, format: str, max_size=None, workers: int=None) -> BytesIO:
+        '''
+        :Private Function:
+
+        Returns img watermarked and encoded as format (jpeg, png, tiff or bmp) using the encoder parameters of format.
+        Multi-page TIFFs and animated PNGs are watermarked page by page, see _waterMarkPages.
+
+        :param max_size: Optional maximum output size, either the longest side in pixels or a (width, height) box.
+            Larger images are scaled down to fit, keeping their aspect ratio, see _decodeImage.
+
+        :param workers: Threads watermarking the pages of multi-page images. Default None uses all cores.
+        '''
+        if format in ("tiff", "png") and _pageCount(img) > 1:
+            return self._waterMarkPages(img, text_to_write, format, max_size, workers)
+        with _stage("decode"):
+            given_image = self._decodeImage(img, max_size)
+        # blend in place into the decoded image
+        blend = self._blendWaterMark(given_image, text_to_write)
         
+        with _stage("encode"):
+            is_success, buffer = cv2.imencode(_imageExtensions[format], blend, self._encoderFlags.get(format, []))
         
-        #Create blank image with all zeros. Width is doubled for rotations
-        blank = np.zeros(shape=img.shape, dtype=np.uint8)
-        
-        #First line
-        num= int(img_height * 25/100)
-        
-        text_location=(wm.textX, num)
-        cv2.putText(blank, text=text_to_write, org = text_location, fontFace = wm.font, fontScale = wm.font_size, color=(200, 200, 200), thickness=wm.thickness, lineType=cv2.LINE_8)
-        
-        #Second line
-        num= int(img_height * 50/100)
-        text_location=(wm.textX, num)
-        cv2.putText(blank, text=text_to_write, org = text_location, fontFace = wm.font, fontScale = wm.font_size, color=(200, 200, 200), thickness=wm.thickness, lineType=cv2.LINE_8)
-        
-        #Third line
-        num= int(img_height * 75/100)
-        text_location=(wm.textX, num)
-        cv2.putText(blank, text=text_to_write, org = text_location, fontFace = wm.font, fontScale = wm.font_size, color=(200, 200, 200), thickness=wm.thickness, lineType=cv2.LINE_8)
+        if is_success:
+            decode_image=BytesIO(buffer)
+            return decode_image
+        else:
+            return img
+
+    @staticmethod
+    def _decodeImage(img: bytes, max_size=None):
+        '''
+        :Private Function:
+
+        Decodes img as BGR image. With max_size the image is decoded with the largest of the
+        cv2.IMREAD_REDUCED_COLOR_2/4/8 modes which still gives at least the target size; for JPEG these
+        decode straight at the reduced size. The rest is scaled down with INTER_AREA.
+        '''
+        nparr = np.frombuffer(img, np.uint8)
+        mode = cv2.IMREAD_COLOR
+        if max_size is not None:
+            maxWidth, maxHeight = (max_size, max_size) if isinstance(max_size, int) else max_size
+            size = _imageSize(img)
+            if size is not None:
+                width, height = size
+                # the decoder may apply EXIF orientation, so allow for swapped sides
+                scale = max(min(maxWidth / width, maxHeight / height), min(maxWidth / height, maxHeight / width))
+                for factor, reduced in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2)):
+                    if scale * factor <= 1:
+                        mode = reduced
+                        break
+        given_image=cv2.imdecode(nparr, mode)
+        if given_image is None:
+            raise ValueError("Could not decode the given image")
+        return WaterMarker._scaleDown(given_image, max_size)
+
+    @staticmethod
+    def _scaleDown(image, max_size=None):
+        '''
+        :Private Function:
+
+        Returns image scaled down with INTER_AREA to fit max_size, image itself if it fits already.
+        '''
+        if max_size is None:
+            return image
+        maxWidth, maxHeight = (max_size, max_size) if isinstance(max_size, int) else max_size
+        height, width = image.shape[:2]
+        scale = min(maxWidth / width, maxHeight / height)
+        if scale < 1:
+            size = (max(1, round(width * scale)), max(1, round(height * scale)))
+            image = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        return image
+
+    def _waterMarkPages(self, img: bytes, text_to_write: str, format: str, max_size=None, workers: int=None) -> BytesIO:
+        '''
+        :Private Function:
+
+        Returns all pages of a multi-page TIFF, or all frames of an animated PNG, watermarked and encoded again
+        into one image of format.
+
+        TIFF pages are decoded with cv2.imdecodemulti and encoded with cv2.imencodemulti. Animated PNGs are read
+        and written with cv2.imreadanimation and cv2.imwriteanimation, keeping the frame durations and loop count,
+        through memory backed scratch files where available. Pages of the same size share one cached overlay and
+        are blended by a pool of workers threads. Alpha channels of frames are kept as they are.
+        '''
+        animation = None
+        with _stage("decode"):
+            if format == "tiff":
+                ok, pages = cv2.imdecodemulti(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)
+            else:
+                with _scratchFile(img, suffix=".png") as source:
+                    ok, animation = cv2.imreadanimation(source.path)
+                pages = list(animation.frames) if ok else []
+            if not ok or not pages:
+                raise ValueError("Could not decode the given image")
+            pages = [self._scaleDown(page, max_size) for page in pages]
+        _count("pages", len(pages))
+
+        # build the overlay of every page size once before the pages share them
+        for shape in dict.fromkeys(page.shape[:2] + (3,) for page in pages):
+            self._getWaterMarkBands(shape, text_to_write)
+        workers = min(workers or os.cpu_count() or 1, len(pages))
+        with _stage("blend"), ThreadPoolExecutor(max_workers=workers) as executor:
+            pages = list(executor.map(partial(self._blendPage, text_to_write=text_to_write), pages))
+
+        flags = self._encoderFlags.get(format, [])
+        with _stage("encode"):
+            if format == "tiff":
+                is_success, buffer = cv2.imencodemulti(".tiff", pages, flags)
+                return BytesIO(buffer) if is_success else img
+            animation.frames = pages
+            with _scratchFile(suffix=".png") as target, tempfile.TemporaryDirectory() as folder:
+                path = target.path
+                if not target.onDisk:
+                    # the encoder is picked by the extension, which the memfd path has not
+                    path = os.path.join(folder, "frames.png")
+                    os.symlink(target.path, path)
+                if not cv2.imwriteanimation(path, animation, flags):
+                    return img
+                return BytesIO(target.read())
+
+    def _blendPage(self, page, text_to_write: str):
+        '''
+        :Private Function:
+
+        Blends the watermark into the colours of page in place and returns it, the alpha channel of BGRA pages is kept.
+        '''
+        if page.ndim == 3 and page.shape[2] == 4:
+            colours = np.ascontiguousarray(page[..., :3])
+            self._blendWaterMark(colours, text_to_write)
+            page[..., :3] = colours
+            return page
+        return self._blendWaterMark(page, text_to_write)
 
-        #Rotate and merge image - NOT IN USE
-        #angle=0
-        #M=cv2.getRotationMatrix2D(text_location,angle,1)
-        #out=cv2.warpAffine(blank,M,(img_width, img_height))
-        
-        # Convert 0s to 1s and 1s to 0s to invert colors black and white for readability
-        out=cv2.bitwise_not(blank)
-        return out
-   
     # Converts PNG image to watermarked image and returns Watermarked image
-    def WaterMark_PNG(self, img: bytes, text_to_write: str) -> BytesIO:
+    @_instrumented
+    @_cached
+    def WaterMark_PNG(self, img: bytes, text_to_write: str, max_size=None, workers: int=None) -> BytesIO:
         
         """
         Functions returns watermarked image with blend.
@@ -134,26 +1649,20 @@ class WaterMarker():
             img = cur.execute(qryArch, param).fetchval()
         
         :param text_to_write: Text to be used as watermark  
-        
-        :param extension: The extension of the img format which can be JPG, JPEG or PNG
+
+        :param max_size: Optional maximum output size, longest side in pixels or (width, height). Larger images are
+            decoded at reduced resolution and scaled down to fit.
+
+        :param workers: Threads watermarking the frames of animated PNGs in parallel, which keep their durations
+            and loop count. Default None uses all cores.
         
         """
-        nparr = np.fromstring(img, np.uint8)
-        given_image=cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        imgWM = self._getBlankWaterMarkImage(given_image, text_to_write)
-        
-        blend = cv2.addWeighted(src1=given_image, alpha=0.7, src2=imgWM, beta=0.3,gamma=0.5)
-        
-        is_success, buffer = cv2.imencode(".png", blend)
-        
-        if is_success:
-            decode_image=BytesIO(buffer)
-            return decode_image
-        else:
-            return img
+        return self._waterMarkImage(img, text_to_write, "png", max_size, workers)
     
     # Converts TIFF image to watermarked image and returns Watermarked image
-    def WaterMark_TIFF(self, img: bytes, text_to_write: str) -> BytesIO:
+    @_instrumented
+    @_cached
+    def WaterMark_TIFF(self, img: bytes, text_to_write: str, max_size=None, workers: int=None) -> BytesIO:
         '''
         Functions returns watermarked image with blend.
         
@@ -164,26 +1673,90 @@ class WaterMarker():
             img = cur.execute(qryArch, param).fetchval()
         
         :param text_to_write: Text to be used as watermark  
-        
-        :param extension: The extension of the img format which can be JPG, JPEG or PNG
+
+        :param max_size: Optional maximum output size, longest side in pixels or (width, height). Larger images are
+            decoded at reduced resolution and scaled down to fit.
+
+        :param workers: Threads watermarking the pages of multi-page TIFFs in parallel, all pages are kept.
+            Default None uses all cores.
         
         '''
-        nparr = np.fromstring(img, np.uint8)
-        given_image=cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        imgWM = self._getBlankWaterMarkImage(given_image, text_to_write)
-        
-        blend = cv2.addWeighted(src1=given_image, alpha=0.7, src2=imgWM, beta=0.3,gamma=0.5)
-        
-        is_success, buffer = cv2.imencode(".tiff", blend)
-        
-        if is_success:
-            decode_image=BytesIO(buffer)
-            return decode_image
-        else:
-            return img
+        return self._waterMarkImage(img, text_to_write, "tiff", max_size, workers)
     
+    # Watermarks an uncompressed TIFF file strip by strip or tile by tile
+    @_instrumented
+    def WaterMark_TIFF_Tiled(self, source: str, target: str, text_to_write: str, chunk_bytes: int=64 * 1024 * 1024) -> str:
+        '''
+        Function watermarks a TIFF file too large to be decoded in memory, e.g. gigapixel maps and scans, and
+        returns the path of the watermarked file.
+
+        The strips or tiles of the TIFF are memory mapped and blended in place a few at a time, each with the
+        part of the overlay of the full image it covers, so the pixels are exactly the ones of WaterMark_TIFF
+        while memory stays within about chunk_bytes whatever the image size. The file keeps its layout, colours
+        and tags. Supports classic and BigTIFF files with uncompressed 8 bit grayscale or RGB pixels, other
+        TIFFs raise ValueError and can be watermarked with WaterMark_TIFF.
+
+        :param source: Path of the TIFF file to be watermarked.
+
+        :param target: Path the watermarked TIFF is written to, None watermarks source in place.
+
+        :param text_to_write: Text to be used as watermark
+
+        :param chunk_bytes: Bytes of the file mapped at a time.
+        '''
+        with open(source, "rb") as file:
+            layout = _readTiffLayout(file)
+        if target is None:
+            target = source
+        elif os.path.abspath(target) != os.path.abspath(source):
+            with _stage("copy"):
+                shutil.copyfile(source, target)
+
+        colour = layout.colour
+        overlay = self._getWaterMarkBands((layout.height, layout.width, colour) if colour > 1 else (layout.height, layout.width), text_to_write)
+        # strips and tiles are cut into row ranges of at most chunk_bytes, then mapped in groups of neighbours
+        pieces = []
+        for offset, y, x, rows, columns in sorted(layout.chunks):
+            rowBytes = columns * layout.depth
+            step = max(1, chunk_bytes // rowBytes)
+            for row in range(0, rows, step):
+                pieces.append((offset + row * rowBytes, y + row, x, min(step, rows - row), columns))
+
+        with open(target, "r+b") as file:
+            start = 0
+            while start < len(pieces):
+                _checkCancelled()
+                first = pieces[start][0]
+                end = start + 1
+                while end < len(pieces) and pieces[end][0] + pieces[end][3] * pieces[end][4] * layout.depth - first <= chunk_bytes:
+                    end += 1
+                last = pieces[end - 1]
+                size = last[0] + last[3] * last[4] * layout.depth - first
+                with _stage("map"):
+                    window = np.asarray(np.memmap(file, dtype=np.uint8, mode="r+", offset=first, shape=(size,)))
+                with _stage("blend"):
+                    for offset, y, x, rows, columns in pieces[start:end]:
+                        shape = (rows, columns, layout.depth) if layout.depth > 1 else (rows, columns)
+                        pixels = window[offset - first:offset - first + rows * columns * layout.depth].reshape(shape)
+                        # tiles at the right and bottom edges are padded beyond the image
+                        pixels = pixels[:min(rows, layout.height - y), :min(columns, layout.width - x)]
+                        bands = _cropBands(overlay, y, x, pixels.shape[0], pixels.shape[1])
+                        if layout.depth == colour:
+                            _blendBands(pixels, bands, pixels)
+                        else:
+                            # extra samples such as alpha are kept
+                            colours = np.ascontiguousarray(pixels[..., :colour] if colour > 1 else pixels[..., 0])
+                            _blendBands(colours, bands, colours)
+                            pixels[..., :colour] = colours.reshape(colours.shape[:2] + (colour,))
+                _count("tiles", end - start)
+                del window
+                start = end
+        return target
+
     # Converts JPG image to watermarked image and returns Watermarked image
-    def WaterMark_JPEG(self, img: bytes, text_to_write: str) -> BytesIO:
+    @_instrumented
+    @_cached
+    def WaterMark_JPEG(self, img: bytes, text_to_write: str, max_size=None) -> BytesIO:
         '''
         Functions returns watermarked image with blend.
         
@@ -194,28 +1767,17 @@ class WaterMarker():
             img = cur.execute(qryArch, param).fetchval()
         
         :param text_to_write: Text to be used as watermark  
-        
-        :param extension: The extension of the img format which can be JPG, JPEG or PNG
+
+        :param max_size: Optional maximum output size, longest side in pixels or (width, height). Larger images are
+            decoded at reduced resolution and scaled down to fit.
         
         '''
-        nparr = np.fromstring(img, np.uint8)
-        given_image=cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        imgWM = self._getBlankWaterMarkImage(given_image, text_to_write)
-        
-        blend = cv2.addWeighted(src1=given_image, alpha=0.7, src2=imgWM, beta=0.3,gamma=0.5)
-        
-        is_success, buffer = cv2.imencode(".jpg", blend)
-        
-        if is_success:
-            decode_image=BytesIO(buffer)
-            return decode_image
-        else:
-            return img
-
-        # IN USE
+        return self._waterMarkImage(img, text_to_write, "jpeg", max_size)
     
     # Converts BMP image to watermarked image and returns Watermarked image
-    def WaterMark_BMP(self, img: bytes, text_to_write: str) -> BytesIO:
+    @_instrumented
+    @_cached
+    def WaterMark_BMP(self, img: bytes, text_to_write: str, max_size=None) -> BytesIO:
         '''
         Functions returns watermarked image with blend.
         
@@ -226,265 +1788,937 @@ class WaterMarker():
             img = cur.execute(qryArch, param).fetchval()
         
         :param text_to_write: Text to be used as watermark  
-        
-        :param extension: The extension of the img format which can be JPG, JPEG or PNG
+
+        :param max_size: Optional maximum output size, longest side in pixels or (width, height). Larger images are
+            decoded at reduced resolution and scaled down to fit.
         
         '''
-        nparr = np.fromstring(img, np.uint8)
-        given_image=cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-        imgWM = self._getBlankWaterMarkImage(given_image, text_to_write)
-        
-        blend = cv2.addWeighted(src1=given_image, alpha=0.7, src2=imgWM, beta=0.3,gamma=0.5)
-        
-        is_success, buffer = cv2.imencode(".bmp", blend)
-        
-        if is_success:
-            decode_image=BytesIO(buffer)
-            return decode_image
-        else:
-            return img
-    
-    #Uses Moviepy to generate watermarked Video
-    def WaterMark_Video(self, video: bytes, text_to_write: str="WaterMark", extension: str="mp4") -> BytesIO:
+        return self._waterMarkImage(img, text_to_write, "bmp", max_size)
+
+    # Detects the format of data and sends it to the registered handler
+    @_instrumented
+    @_cached
+    def WaterMark(self, data: bytes, text_to_write: str, format: str=None, **kwargs) -> BytesIO:
+        '''
+        Watermarks images, PDFs, videos and audios, detecting their format from the first bytes of data.
+
+        The data is sent to the handler registered for its format with register_handler, built in handlers
+        exist for jpeg, png, tiff, bmp, pdf, mp4, avi, webm, ogv, wav, ogg and mp3. No decoding is done
+        for the detection, so a wrongly guessed type never costs a failed decode.
+
+        ::
+
+            data = cur.execute(qryArch, param).fetchval()
+            out = wm.WaterMark(data, "Confidential")
+
+        :param data: Bytes of the file which needs to be watermarked.
+
+        :param text_to_write: Text to be used as watermark
+
+        :param format: Optional format name, skipping the detection. Aliases like jpg and tif are accepted.
+
+        :param kwargs: Passed on to the handler, e.g. workers or mode for PDFs.
+        '''
+        if format is None:
+            format = self.detect_format(data)
+            if format is None:
+                raise ValueError("Could not detect the format of the given data")
+        handler = self._handlers.get(format.lower())
+        if handler is None:
+            raise ValueError(f"No handler registered for format {format!r}")
+        return handler.function(self, data, text_to_write, **kwargs)
+
+    @classmethod
+    def detect_format(cls, data: bytes) -> str:
+        '''
+        Returns the name of the registered format whose signature matches the first bytes of data, None if none does.
+        Handlers registered later are tried first.
+        '''
+        head = bytes(data[:_sniffLength])
+        for format, handler in reversed(cls._handlers.items()):
+            for signature in handler.signatures:
+                if callable(signature):
+                    if signature(head):
+                        return format
+                else:
+                    offset, magic = signature
+                    if head[offset:offset + len(magic)] == magic:
+                        return format
+        return None
+
+    @classmethod
+    def register_handler(cls, format: str, function, signatures=(), media: str="image"):
+        '''
+        Registers function as handler of format for WaterMark, replacing a handler registered before.
+
+        ::
+
+            def watermark_gif(marker, data, text_to_write, **kwargs):
+                ...
+                return BytesIO(out)
+
+            WaterMarker.register_handler("gif", watermark_gif, signatures=[(0, b"GIF87a"), (0, b"GIF89a")])
+
+        :param format: Name of the format, matched case insensitively.
+
+        :param function: Callable(marker, data, text_to_write, **kwargs) returning the watermarked data as BytesIO.
+
+        :param signatures: (offset, magic bytes) tuples or callables taking the first bytes of the data and
+            returning True on a match. A format without signatures can only be selected by name.
+
+        :param media: Media type of the format (image, pdf, video or audio), used for concurrency limits of AsyncWaterMarker.
+        '''
+        # copy on first registration so a subclass does not change the handlers of its base class
+        if "_handlers" not in cls.__dict__:
+            cls._handlers = OrderedDict(cls._handlers)
+        cls._handlers.pop(format.lower(), None)
+        cls._handlers[format.lower()] = _handler(function, tuple(signatures), media)
+
+    def set_encoder_params(self, format: str, params: dict):
+        '''
+        Sets the encoder parameters used when writing images of format, replacing the ones set before.
+
+        ::
+
+            wm.set_encoder_params("jpeg", {"quality": 85, "progressive": 1})
+            wm.set_encoder_params("png", {"compression": 9})
+            wm.set_encoder_params("tiff", {"compression": 5})    # 5 = LZW
+
+        :param format: jpeg, png, tiff or bmp (jpg and tif are accepted too).
+
+        :param params: Dictionary of parameter names (see _encoderParamNames) or cv2.IMWRITE_* flags and their values.
+        '''
+        format = _imageAliases.get(format.lower(), format.lower())
+        if format not in _imageExtensions:
+            raise ValueError(f"Unsupported image format {format!r}")
+        names = _encoderParamNames()[format]
+        flags = []
+        for name, value in params.items():
+            if isinstance(name, str):
+                if name not in names:
+                    raise ValueError(f"Unknown {format} encoder parameter {name!r}, use one of {', '.join(names)}")
+                name = names[name]
+            flags += [int(name), int(value)]
+        self.encoder_params[format] = dict(params)
+        self._encoderFlags[format] = flags
+
+    @staticmethod
+    def temp_stats() -> dict:
+        """
+        Returns the bytes video and audio calls wrote to temporary files on disk, for monitoring.
+
+        "calls" and "bytes" are totals of the process, "last_call_bytes" is the count of the last call
+        made in the calling thread. Where memory backed files are available (Linux) only the segments
+        of parallel video encoding go to disk.
+        """
+        with _tempUsageLock:
+            return {"calls": _tempUsage["calls"], "bytes": _tempUsage["bytes"],
+                    "last_call_bytes": getattr(_callState, "tempBytes", 0)}
+
+    # Watermarks many images on a thread pool
+    def WaterMark_Batch(self, items, workers: int=None, ordered: bool=True, **kwargs):
+        '''
+        Watermarks many images and yields a BatchResult for each of them.
+
+        Images are processed on a thread pool, cv2 releases the GIL while decoding, blending and encoding
+        so the threads run in parallel. A failing item does not stop the batch, its exception is returned
+        in BatchResult.error. Items are read from the iterable as workers become free, so large batches
+        are never loaded into memory at once.
+
+        ::
+
+            rows = cur.execute(qryArch, param).fetchall()
+            for res in wm.WaterMark_Batch((row.img, user_name, "jpeg") for row in rows):
+                if res.error is None:
+                    send(res.output)
+
+        :param items: Iterable of (bytes, text_to_write, format) tuples, format being a format registered for WaterMark
+            (jpeg, png, tiff, bmp, ...) or None to detect it.
+
+        :param workers: Number of threads. Default None uses all cores.
+
+        :param ordered: True (default) yields results in the order of items, False yields them as they complete.
+
+        :param kwargs: Passed on to WaterMark for every item, e.g. max_size.
+        '''
+        workers = workers or os.cpu_count() or 1
+        window = workers * 2
+        waterMarkItem = partial(self._waterMarkBatchItem, **kwargs)
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            if ordered:
+                yield from self._orderedWindow(executor, waterMarkItem, enumerate(items), window)
+                return
+            pending = set()
+            for item in enumerate(items):
+                pending.add(executor.submit(waterMarkItem, item))
+                if len(pending) >= window:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield future.result()
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+    def _waterMarkBatchItem(self, item: tuple, **kwargs) -> BatchResult:
+        '''
+        :Private Function:
+
+        Watermarks one (index, (bytes, text_to_write, format)) item of WaterMark_Batch.
+        '''
+        index, (img, text_to_write, format) = item
+        try:
+            return BatchResult(index, self.WaterMark(img, text_to_write, format=format, **kwargs), None)
+        except Exception as e:
+            return BatchResult(index, None, e)
+
+    # Uses ffmpeg of imageio-ffmpeg to decode and encode the frames, which are watermarked with cv2
+    @_instrumented
+    @_cached
+    def WaterMark_Video(self, video: bytes, text_to_write: str="WaterMark", extension: str="mp4", workers: int=1, segment_seconds: float=10) -> BytesIO:
         '''
         Functions returns watermarked video.
+
+        Frames are decoded by ffmpeg and piped raw into the process, the watermark is blended into every
+        frame in place with the overlay built once for the frame size, and the frames are piped raw to a
+        second ffmpeg which encodes them. The audio stream is copied without re-encoding when the output
+        container takes its codec. ImageMagick is not needed. Input and output are held in memory backed
+        files where the system offers them (Linux), see temp_stats.
         
         :param video: Retrieved bytes data of a video file.
         
         :param text_to_write: Text to be used as watermark.
 
         :param extension: The extension to determine the video file format. These can be mp4, avi, ogv, webm.
+
+        :param workers: Number of processes encoding segments of the video in parallel. Default 1 encodes the
+            whole video in the calling process, None uses all cores. Where processes are spawned (Windows, macOS)
+            the calling script needs an if __name__ == "__main__" guard.
+
+        :param segment_seconds: Length of the segments when workers > 1. The video is cut at the first keyframe
+            after every segment_seconds, so a video with few keyframes gives fewer, longer segments.
         
         '''
-        
-        with tempfile.NamedTemporaryFile(delete=False) as fp:
-            fp.write(video)
-            
-            vid = mpE.VideoFileClip(fp.name)
-            width, height = vid.size
-            dur = vid.duration
-            #logo = TextClip(txt=text_to_write,size=(width,height),bg_color='transparent')
-            
-            txtClip = (mpE.TextClip(text_to_write, fontsize=15,
-                font="Century-Schoolbook-Roman", color="gray")
-                .margin(top=int((height/2)-15), opacity=0)
-                .set_position(("center","top")))
-            
-            final = (mpE.CompositeVideoClip(size=(width,height),clips=[vid, txtClip],bg_color=None,use_bgclip=True)
-            .set_duration(dur))
-            ext="."+extension
-            Kodek = 'libx264'
-            if ext == '.mp4':
-                Kodek = 'libx264' 
-            elif ext == '.avi':
-                Kodek = 'rawvideo'
-            elif ext == '.ogv':
-                Kodek = 'libvorbis'
-            elif ext == '.webm':
-                Kodek == 'libvpx'
-                
-            with tempfile.NamedTemporaryFile(delete=True) as f:
-                final.write_videofile(f.name + ext, codec=Kodek)
-                
-                with open (f.name+ext,'rb') as file:
-                    cont = file.read()
-                    file.close()
-            return BytesIO(cont)
+        if extension.lower() not in _videoFormats:
+            raise ValueError(f"Unsupported video format {extension!r}, use one of {', '.join(_videoFormats)}")
+        extension = extension.lower()
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        # ffmpeg needs to seek in both, e.g. to the index at the end of an mp4
+        with _tempAccounting(), _scratchFile(video) as source, _scratchFile(suffix="." + extension) as target:
+            if workers > 1:
+                self._waterMarkVideoSegments(source.path, target.path, text_to_write, extension, workers, segment_seconds)
+            else:
+                self._waterMarkVideoFile(source.path, target.path, text_to_write, extension)
+            return BytesIO(target.read())
+
+    def _waterMarkVideoFile(self, source: str, target: str, text_to_write: str, extension: str, audio: bool=True):
+        '''
+        :Private Function:
+
+        Watermarks the video file source into the video file target of format extension.
+
+        :param audio: Copy (or if needed encode) the first audio stream of source into target.
+        '''
+        format = _videoFormats[extension]
+        frames = imageio_ffmpeg.read_frames(source, pix_fmt="bgr24")
+        try:
+            meta = next(frames)
+            width, height = meta["size"]
+            fps = meta["fps"] or 25
+            cmd = ["-f", "rawvideo", "-pix_fmt", "bgr24", "-s", f"{width}x{height}", "-r", repr(fps), "-i", "-"]
+            if audio:
+                cmd += _audioArgs(source, meta, format)
+            # yuv420p needs even sides
+            cmd += ["-c:v", format.codec] + format.options + ["-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-f", format.muxer, target]
+
+            encoder = _ffmpegProcess(cmd, stdout=subprocess.DEVNULL)
+            try:
+                frame = np.empty((height, width, 3), dtype=np.uint8)
+                try:
+                    for raw in _timed(frames, "decode"):
+                        _checkCancelled()
+                        _count("frames")
+                        self._blendWaterMark(np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 3), text_to_write, dst=frame)
+                        with _stage("encode"):
+                            encoder.process.stdin.write(frame.data)
+                    encoder.process.stdin.close()
+                except BrokenPipeError:
+                    # ffmpeg stopped, the reason is in its log
+                    pass
+                with _stage("encode"):
+                    encoder.finish("encode the video")
+            finally:
+                encoder.kill()
+        finally:
+            frames.close()
     
+    def _waterMarkVideoSegments(self, source: str, target: str, text_to_write: str, extension: str, workers: int, segment_seconds: float):
+        '''
+        :Private Function:
+
+        Watermarks the video file source into the video file target like _waterMarkVideoFile, with segments
+        of the video encoded in parallel by workers processes.
+
+        The video stream is cut at keyframes without re-encoding, so every segment decodes on its own and
+        their frames add up to exactly those of source. The watermarked segments are joined by the concat
+        demuxer without re-encoding and the audio of source is added to the joined video in the same step.
+        The segments are written to a temporary directory, which is counted by temp_stats.
+        '''
+        with tempfile.TemporaryDirectory() as folder:
+            try:
+                with _stage("split"):
+                    _runFfmpeg(["-i", source, "-map", "0:v:0", "-c", "copy", "-f", "segment", "-segment_time", repr(segment_seconds),
+                                "-segment_format", "matroska", "-reset_timestamps", "1", os.path.join(folder, "in%06d.mkv")])
+                segments = sorted(name for name in os.listdir(folder) if name.startswith("in"))
+                if len(segments) < 2:
+                    # a single keyframe interval, nothing to share out
+                    return self._waterMarkVideoFile(source, target, text_to_write, extension)
+
+                jobs = [(os.path.join(folder, name), os.path.join(folder, "out" + name[2:-4] + "." + extension)) for name in segments]
+                workers = min(workers, len(jobs))
+                executor = ProcessPoolExecutor(max_workers=workers, initializer=_initVideoWorker, initargs=(text_to_write, extension))
+                try:
+                    # decode, blend and encode happen in the workers, the call records the time it waits for them
+                    for _ in _timed(self._orderedWindow(executor, _waterMarkVideoSegmentInWorker, jobs, workers * 2), "workers"):
+                        _checkCancelled()
+                        _count("segments")
+                finally:
+                    executor.shutdown(cancel_futures=True)
+
+                concat = os.path.join(folder, "segments.txt")
+                with open(concat, "w") as file:
+                    file.writelines(f"file '{output}'\n" for _, output in jobs)
+                format = _videoFormats[extension]
+                with _stage("join"):
+                    _runFfmpeg(["-f", "concat", "-safe", "0", "-i", concat] + _audioArgs(source, _videoMeta(source), format)
+                               + ["-c:v", "copy", "-f", format.muxer, target])
+            finally:
+                _addTempBytes(sum(entry.stat().st_size for entry in os.scandir(folder)))
+
+    # Renders one page of pd and returns it watermarked as JPEG
+    def _waterMarkPdfPage(self, pd, index: int, text_to_write: str, scale: float=_PDF_SCALE) -> tuple:
+        '''
+        :Private Function:
+
+        Renders page index of pd, watermarks it and returns a tuple of (jpeg bytes, width, height).
+
+        :param pd: Opened pdfium.PdfDocument.
+
+        :param index: Zero based index of the page.
+
+        :param text_to_write: Text to be used as watermark
+
+        :param scale: Render scale in pixels per point.
+        '''
+        with _stage("render"):
+            page = pd[index]
+            bitmap = page.render(scale=scale)
+            page.close()
+            # view on the pdfium buffer without copying, pdfium renders BGR as used by cv2
+            img = bitmap.to_numpy()
+            if img.shape[2] == 4:
+                img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        # blend in place and encode to JPEG once
+        self._blendWaterMark(img, text_to_write)
+        with _stage("encode"):
+            is_success, buffer = cv2.imencode(".jpg", img, self._encoderFlags.get("jpeg") or [cv2.IMWRITE_JPEG_QUALITY, _PDF_JPEG_QUALITY])
+        height, width = img.shape[:2]
+        # release the pdfium bitmap as soon as the page is encoded
+        bitmap.close()
+        if not is_success:
+            raise ValueError(f"Could not encode page {index} as JPEG")
+        return buffer.tobytes(), width, height
+
     # Method using pdfium to return watermarked PDF
-    def WaterMark_PDF(self, pdf: bytes, text_to_write: str) -> BytesIO:
+    @_instrumented
+    @_cached
+    def WaterMark_PDF(self, pdf: bytes, text_to_write: str, workers: int=1, window: int=None, out=None, mode: str="raster",
+                      pages=None, scale: float=_PDF_SCALE) -> BytesIO:
         '''
         Functions uses pdfium to create and return watermarked PDF file.
+
+        In the default "raster" mode every page is rendered to an image and the watermark is burnt into it,
+        so the text of the document can not be copied any more. In "vector" mode the original pages are kept
+        and the watermark is added to each of them as semi transparent text; see _waterMarkPdfVector.
+
+        Pages are streamed: each page is rendered, watermarked and inserted into the new document before the
+        next one is rendered, so only a few page bitmaps are held at any time whatever the page count.
         
         :param pdf: Retrived bytes of pdf file which needs to be watermarked.
         
         :param text_to_write: Text to be used as watermark  
 
+        :param workers: Number of processes used to render, watermark and encode pages. Default 1 processes
+            all pages in the calling process, None uses all cores. Each worker opens the PDF itself from pdf bytes.
+            Where processes are spawned (Windows, macOS) the calling script needs an if __name__ == "__main__" guard.
+
+        :param window: Maximum number of pages in flight when workers > 1. Default is twice the number of workers.
+
+        :param out: Optional writable file-like sink. The document is written into it in steps and out is returned
+            instead of a new BytesIO.
+
+        :param mode: "raster" (default) or "vector". workers, window and scale only apply to raster mode.
+
+        :param pages: Optional zero based indexes of the pages to keep, e.g. range(10). They are written in
+            document order. Default None keeps all pages.
+
+        :param scale: Render scale of raster pages in pixels per point. Lower scales render faster and give
+            smaller files at a lower resolution, the size of the pages stays the same.
+
         '''
-        # Create an empty array for holding the pages data read from given PDF file.
-        ImgList=[]
-        pd = pdfium.PdfDocument(BytesIO(pdf))
-        # read all pages from pdf, convert to bitmap PIL images and save into a list
-        for page in pd:
-            # get pages - currently scale is 2 for increased quality of images
-            img = page.render(scale=2)
-            # append read image to list
-            ImgList.append(img.to_pil())
-        
+        if mode == "vector":
+            return self._waterMarkPdfVector(pdf, text_to_write, out, pages)
+        elif mode != "raster":
+            raise ValueError(f"Unknown PDF watermarking mode {mode!r}, use 'raster' or 'vector'")
+
         # Generate a new empty pdf        
         pdNew = pdfium.PdfDocument.new()
-        # convert all images in the list to watermakred jpg images and insert into new PDF
-        for img in ImgList: # img is in PIL Bitmap image
-            # setting initial value to page as A4, will be changed later
-            width, height = (595, 842) #Set width & height to A4
-            # convert PIL image to RGB
-            img = img.convert('RGB')
-            # create BytesIO to save PIL img to bytes
-            img_byte_arr = BytesIO()
-            # save img to BytesIO
-            img.save(img_byte_arr,format="JPEG",quality=80, optimize=True, progressive=True)
-            # read the saved image back to BytesIO
-            bio=BytesIO()
-            bio = img_byte_arr.getvalue()
-            # send image for watermarking
-            wmImage = self.WaterMark_JPEG(img=bio,text_to_write=text_to_write)
-            # now wmImage has our watermarked image
-            # create new pdfBitmap image to be included in pdNew
-            image = pdfium.PdfImage.new(pdNew)
-            # load watermakred image into pdfBitmap
-            image.load_jpeg((wmImage))
-            # get size of img to get matrix for setting size of pdfBitmap
-            width,height = img.size
-            matrix = pdfium.PdfMatrix().scale(width, height)
-            # set image matrix
-            image.set_matrix(matrix)
-            # create new empty page of width height
-            page = pdNew.new_page(width, height)
-            #write image into page
-            page.insert_obj(image)
-            # generate page
-            page.gen_content()
-        
-        # now all images inserted and pdf is ready to be saved
-        # Save new pdf to memory and return 
-        ret = BytesIO()
-        pdNew.save(ret)
-        return BytesIO(ret.getvalue())
-
-    # This function uses pydub and ffmpeg. install ffmpeg and set environment variable to its bin folder
-    def WaterMark_WAV(self, audio: bytes, text_to_write: str, voice_index: int=28) -> BytesIO:
+        try:
+            # pages arrive in document order from both the serial and the parallel path
+            for _, wmImage, width, height in self._waterMarkPdfPages(pdf, text_to_write, pages, workers, window, scale):
+                _count("pages")
+                with _stage("insert"):
+                    self._insertPdfPage(pdNew, wmImage, width, height, scale)
+
+            # now all images inserted and pdf is ready to be saved
+            # Save new pdf to the sink, pdfium writes it in blocks
+            ret = out if out is not None else BytesIO()
+            with _stage("save"):
+                pdNew.save(ret)
+        finally:
+            pdNew.close()
+        if out is None:
+            ret.seek(0)
+        return ret
+
+    def WaterMark_PDF_Pages(self, pdf: bytes, text_to_write: str, pages=None, format: str="pdf", workers: int=1,
+                            window: int=None, scale: float=_PDF_SCALE):
+        '''
+        Generator watermarking the pages of a PDF like WaterMark_PDF in raster mode, yielding (index, bytes) of
+        every page as soon as it is done, first page first. A viewer can show the first page without waiting
+        for the rest of the document.
+
+        ::
+
+            for index, page in wm.WaterMark_PDF_Pages(pdf, "Confidential", pages=range(5), format="jpeg", scale=1):
+                send(index, page)
+
+        :param pdf: Retrived bytes of pdf file which needs to be watermarked.
+
+        :param text_to_write: Text to be used as watermark
+
+        :param pages: Optional zero based indexes of the pages, yielded in document order. Default None yields all pages.
+
+        :param format: "pdf" (default) yields every page as a single page PDF, "jpeg" as the JPEG of the page.
+
+        :param workers: Number of processes rendering pages ahead, see WaterMark_PDF.
+
+        :param window: Maximum number of pages in flight when workers > 1, see WaterMark_PDF.
+
+        :param scale: Render scale in pixels per point, see WaterMark_PDF.
+        '''
+        if format not in ("pdf", "jpeg"):
+            raise ValueError(f"Unsupported page format {format!r}, use 'pdf' or 'jpeg'")
+        for index, wmImage, width, height in self._waterMarkPdfPages(pdf, text_to_write, pages, workers, window, scale):
+            if format == "jpeg":
+                yield index, wmImage
+                continue
+            pdNew = pdfium.PdfDocument.new()
+            try:
+                self._insertPdfPage(pdNew, wmImage, width, height, scale)
+                ret = BytesIO()
+                pdNew.save(ret)
+            finally:
+                pdNew.close()
+            yield index, ret.getvalue()
+
+    def _waterMarkPdfPagesInto(self, pageQueue, pdf: bytes, text_to_write: str, pages=None, **kwargs):
+        '''
+        :Private Function:
+
+        Puts the (index, bytes) of WaterMark_PDF_Pages on pageQueue as soon as they are done, then None, also
+        when watermarking fails, for readers in other threads or processes. The document is opened once for
+        all pages. Waits while pageQueue is full, until the call is cancelled.
+        '''
+        try:
+            for page in self.WaterMark_PDF_Pages(pdf, text_to_write, pages, **kwargs):
+                _putWaiting(pageQueue, page)
+        finally:
+            # a cancelled reader is gone and does not need the end
+            with contextlib.suppress(WaterMarkCancelled):
+                _putWaiting(pageQueue, None)
+
+    @staticmethod
+    def _pdfPageSelection(pageCount: int, pages=None) -> list:
+        '''
+        :Private Function:
+
+        Returns the sorted zero based indexes of pages, all pages of the document for None.
+        '''
+        if pages is None:
+            return list(range(pageCount))
+        selection = sorted(set(pages))
+        for index in selection:
+            if not isinstance(index, int) or not 0 <= index < pageCount:
+                raise ValueError(f"Page {index!r} is not in the document of {pageCount} pages")
+        return selection
+
+    def _waterMarkPdfPages(self, pdf: bytes, text_to_write: str, pages=None, workers: int=1, window: int=None, scale: float=_PDF_SCALE):
+        '''
+        :Private Function:
+
+        Yields (index, jpeg bytes, width, height) of the selected pages of pdf watermarked by _waterMarkPdfPage,
+        in document order, rendered in the calling process or by workers processes.
+        '''
+        pd = pdfium.PdfDocument(BytesIO(pdf))
+        try:
+            selection = self._pdfPageSelection(len(pd), pages)
+        except ValueError:
+            pd.close()
+            raise
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = max(1, min(workers, len(selection)))
+
+        if workers > 1:
+            pd.close()
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=_initPdfWorker, initargs=(pdf, text_to_write, self.encoder_params, scale))
+            # render, blend and encode happen in the workers, the call records the time it waits for them
+            results = _timed(self._orderedWindow(executor, _waterMarkPdfPageInWorker, selection, window or workers * 2), "workers")
+        else:
+            executor = None
+            results = (self._waterMarkPdfPage(pd, index, text_to_write, scale) for index in selection)
+        try:
+            for index, (wmImage, width, height) in zip(selection, results):
+                _checkCancelled()
+                yield index, wmImage, width, height
+        finally:
+            if executor is not None:
+                executor.shutdown(cancel_futures=True)
+            else:
+                pd.close()
+
+    @staticmethod
+    def _insertPdfPage(pdNew, wmImage: bytes, width: int, height: int, scale: float):
+        '''
+        :Private Function:
+
+        Appends a page showing the JPEG wmImage of width x height pixels, rendered at scale, to pdNew.
+        '''
+        # pages keep the size they have at the default scale, whatever the render scale
+        size = _PDF_SCALE / scale
+        # create new pdfBitmap image to be included in pdNew
+        image = pdfium.PdfImage.new(pdNew)
+        # load watermakred image into pdfBitmap, inline so pdfium owns the data and no reader is kept per page
+        image.load_jpeg(BytesIO(wmImage), inline=True)
+        matrix = pdfium.PdfMatrix().scale(width * size, height * size)
+        # set image matrix
+        image.set_matrix(matrix)
+        # create new empty page of width height
+        page = pdNew.new_page(width * size, height * size)
+        #write image into page
+        page.insert_obj(image)
+        # generate page
+        page.gen_content()
+        page.close()
+
+    # Adds watermark text objects to the original pages instead of rasterizing them
+    def _waterMarkPdfVector(self, pdf: bytes, text_to_write: str, out=None, pages=None) -> BytesIO:
+        '''
+        :Private Function:
+
+        Returns the given PDF with the watermark added to every page as text, written in the same three
+        lines at 25%, 50% and 75% of the page height as the raster mode and with the same opacity. Nothing
+        is rendered or encoded.
+
+        The text objects go into a printable stamp annotation of each page, not into the page itself.
+        Regenerating the content of a page makes pdfium drop the resources the page does not use, and pages
+        often share their resources, so the fonts and images of the other pages would be lost. Adding an
+        annotation leaves the content streams and resources of the pages untouched, so pages render and
+        extract text exactly as before apart from the watermark on top.
+
+        :param pdf: Retrived bytes of pdf file which needs to be watermarked.
+
+        :param text_to_write: Text to be used as watermark
+
+        :param out: Optional writable file-like sink, see WaterMark_PDF.
+
+        :param pages: Optional zero based indexes of the pages to keep, see WaterMark_PDF.
+        '''
+        pd = pdfium.PdfDocument(BytesIO(pdf))
+        # UTF-16LE, zero terminated string as expected by FPDFText_SetText
+        text = ctypes.create_string_buffer((text_to_write + "\x00").encode("utf-16-le"))
+        text = ctypes.cast(text, ctypes.POINTER(pdfium_c.FPDF_WCHAR))
+        try:
+            if pages is not None:
+                selection = set(self._pdfPageSelection(len(pd), pages))
+                for index in reversed(range(len(pd))):
+                    if index not in selection:
+                        pd.del_page(index)
+            for page in pd:
+                _checkCancelled()
+                _count("pages")
+                with _stage("insert"):
+                    annot = pdfium_c.FPDFPage_CreateAnnot(page, pdfium_c.FPDF_ANNOT_STAMP)
+                    if not annot:
+                        raise ValueError("Could not add the watermark to the page")
+                    try:
+                        l, b, r, t = page.get_cropbox()
+                        pdfium_c.FPDFAnnot_SetRect(annot, pdfium_c.FS_RECTF(l, t, r, b))
+                        for line in (25, 50, 75):
+                            obj = self._newPdfTextObject(pd, page, text, line)
+                            if not pdfium_c.FPDFAnnot_AppendObject(annot, obj):
+                                raise ValueError("Could not add the watermark to the page")
+                            # owned by the annotation from now on
+                            obj._detach_finalizer()
+                        pdfium_c.FPDFAnnot_SetFlags(annot, pdfium_c.FPDF_ANNOT_FLAG_PRINT)
+                    finally:
+                        pdfium_c.FPDFPage_CloseAnnot(annot)
+                page.close()
+            ret = out if out is not None else BytesIO()
+            with _stage("save"):
+                pd.save(ret)
+        finally:
+            pd.close()
+        if out is None:
+            ret.seek(0)
+        return ret
+
+    @staticmethod
+    def _newPdfTextObject(pd, page, text, line: int):
+        '''
+        :Private Function:
+
+        Creates a centered watermark text object whose baseline is at line percent of the displayed page
+        height, taking the page rotation into account so the text is always upright.
+        '''
+        obj = pdfium.PdfObject(pdfium_c.FPDFPageObj_NewTextObj(pd, b"Helvetica", ctypes.c_float(1)), pdf=pd)
+        pdfium_c.FPDFText_SetText(obj, text)
+        # same gray and opacity as the raster overlay: inverted 200 blended with beta=0.3
+        pdfium_c.FPDFPageObj_SetFillColor(obj, 55, 55, 55, 77)
+        # measure text at font size 1
+        left, bottom, right, top = (ctypes.c_float() for _ in range(4))
+        pdfium_c.FPDFPageObj_GetBounds(obj, left, bottom, right, top)
+        textWidth = max(right.value - left.value, 1e-3)
+
+        l, b, r, t = page.get_cropbox()
+        rotation = page.get_rotation()
+        dispWidth, dispHeight = (r - l, t - b) if rotation in (0, 180) else (t - b, r - l)
+        # fill at most 90% of the width, but never taller than a fifteenth of the page
+        size = min(dispWidth * 0.9 / textWidth, dispHeight / 15)
+        x = (dispWidth - textWidth * size) / 2
+        y = dispHeight * line / 100
+        # map the displayed position (x from left, y from top) to page space
+        if rotation == 90:
+            origin = (l + y, b + x)
+        elif rotation == 180:
+            origin = (r - x, b + y)
+        elif rotation == 270:
+            origin = (r - y, t - x)
+        else:
+            origin = (l + x, t - y)
+        matrix = pdfium.PdfMatrix().scale(size, size).rotate(rotation, ccw=True).translate(*origin)
+        obj.set_matrix(matrix)
+        return obj
+
+    @staticmethod
+    def _orderedWindow(executor, fn, items, window: int):
+        '''
+        :Private Function:
+
+        Yields fn(item) for all items in order, computed on executor with at most window items in flight,
+        so finished results never pile up faster than they are consumed.
+        '''
+        pending = deque()
+        items = iter(items)
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                break
+        while pending:
+            result = pending.popleft().result()
+            for item in items:
+                pending.append(executor.submit(fn, item))
+                break
+            yield result
+
+    # Shared body of the audio methods. Decoding and encoding use the ffmpeg bundled by imageio-ffmpeg
+    def _waterMarkAudio(self, audio: bytes, text_to_write: str, voice_index: int, format: str, interval: float=None, gain: float=0.0) -> BytesIO:
+        """
+        :Private Function:
+
+        Creates a clip with text to speech, mixes it repeatedly into the original audio of format (wav, ogg
+        or mp3) and returns the mixed audio in the same format.
+
+        The audio is decoded once into a sample array, the clip is resampled to its rate and added at every
+        interval over the whole audio with array operations, and the result is encoded once. A wav audio
+        keeps its sample format (8, 16, 24 or 32 bit PCM, 32 or 64 bit float), other sample formats are
+        written as 16 bit PCM.
+
+        :param interval: Seconds from the start of one clip to the start of the next, default repeats the
+            clip without pause. A clip longer than interval is cut to it.
+
+        :param gain: Gain of the clip in dB, 0 adds it at its spoken level.
+        """
+        with _tempAccounting():
+            # audio is raw data, ffmpeg decodes it from a pipe
+            sample = _wavSampleFormat(audio[:1 << 16]) if format == "wav" else "s16"
+            with _stage("decode"):
+                samples, rate = _decodeAudio(audio, sample=sample)
+            _checkCancelled()
+            _count("samples", len(samples))
+
+            clip, period = self._speechClip(text_to_write, voice_index, format, rate, samples.shape[1], interval, gain, sample)
+            if len(samples):
+                with _stage("mix"):
+                    _mixRepeated(samples, clip, period)
+            _checkCancelled()
+            with _stage("encode"):
+                return BytesIO(_encodeAudio(samples, rate, format, sample))
+
+    def _speechClip(self, text_to_write: str, voice_index: int, format: str, rate: int, channels: int, interval: float, gain: float, sample: str="s16") -> tuple:
+        """
+        :Private Function:
+
+        Returns the spoken clip of text_to_write as samples (frames, channels) at rate and gain, ready to be
+        mixed into an audio of format decoded for the sample format sample, and the period of the clip in
+        frames for interval.
+        """
+        # the mp3 method has always asked the engine for an mp3 file, the others for wav
+        speech = "mp3" if format == "mp3" else "wav"
+        # spoken clips are cached, only a new text, voice or format is synthesized
+        with _stage("speech"):
+            clip, clipRate = _decodeAudio(self.speech_cache.get(text_to_write, voice_index, format=speech))
+        _checkCancelled()
+
+        # match the clip to the rate and channels of the audio
+        clip = _resample(clip.mean(axis=1, keepdims=True), clipRate, rate) * 10 ** (gain / 20)
+        clip = np.rint(np.broadcast_to(clip, (len(clip), channels))).astype(np.int32)
+        scale = _sampleFormats[sample].scale
+        if scale != 1:
+            # to the range of the samples, widened so loud clips do not wrap around
+            clip = clip * scale if np.dtype(_sampleFormats[sample].dtype).kind == "f" else clip.astype(np.int64) * scale
+        period = max(1, round(interval * rate)) if interval else max(1, len(clip))
+        return clip, period
+
+    @_instrumented
+    @_cached
+    def WaterMark_WAV(self, audio: bytes, text_to_write: str, voice_index: int=28, interval: float=None, gain: float=0.0) -> BytesIO:
         """
         Creates a wav file with text to speech, overlays it with original audio and returns overlayed file
+        in the sample format of the original audio (8, 16, 24 or 32 bit PCM, 32 or 64 bit float)
 
         :param audio: Retrived bytes of audio file as retrieved from read() function from database.
         
         :param text_to_write: The text required to be spoken by bot and watermarked in audio file.
+
+        :param interval: Seconds between the starts of the spoken text, default repeats it without pause.
+
+        :param gain: Gain of the spoken text in dB.
         
         """
-        # Create wave audio clip for overlaying
-        
-        engine = pyttsx3.init()
-        rate = engine.getProperty('rate')
-        engine.setProperty('rate', rate-100)
-        
-        # Uncomment the following lines to see all the available voices
-        #voices = engine.getProperty('voices') 
-        #for voice in voices: 
-        #    print(f'voice: {voice.name}')
-        
-        # This function depends on the voices installed in the system and requires index of the installed voices; which may vary.
-        engine.setProperty('voice', voice_index)
-        # Save created clip as tempory file and load into audWM
-        with tempfile.NamedTemporaryFile(mode="w", delete=False, prefix="Arch_") as wm:
-            engine.save_to_file(text=text_to_write, filename=wm.name+".wav")
-            
-            engine.runAndWait()
-            audWM = AudioSegment.from_wav(wm.name+".wav")
-            
-            # audio is a raw data so save it to temporary file, as pydub accepts file from disk only.
-            with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_") as org:
-                org.write(audio)
-                # load file to audOrigin; the original file
-                audOrigin = AudioSegment.from_file(file=org.name, format= "wav")
-                
-                # overlay both clips
-                clip: AudioSegment = audOrigin.overlay(audWM,loop=1)
-                
-                # save the newly created clip to temporary file for opening and exporting
-                with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_", suffix="."+"wav") as f:
-                    clip.export(f.name,format="wav")
-                    # open saved file and return buffer as BytesIO
-                    with open(f.name,"rb") as retFile:
-                        buffer = retFile.read()
-                        return BytesIO(buffer)
-
-    def WaterMark_OGG(self, audio: bytes, text_to_write: str, voice_index: int=28) -> BytesIO:
+        return self._waterMarkAudio(audio, text_to_write, voice_index, "wav", interval, gain)
+
+    @_instrumented
+    @_cached
+    def WaterMark_OGG(self, audio: bytes, text_to_write: str, voice_index: int=28, interval: float=None, gain: float=0.0) -> BytesIO:
         """
         Creates a wav file with text to speech, overlays it with original audio and returns overlayed file
 
         :param audio: Retrived bytes of audio file as retrieved from read() function from database.
         
         :param text_to_write: The text required to be spoken by bot and watermarked in audio file.
+
+        :param interval: Seconds between the starts of the spoken text, default repeats it without pause.
+
+        :param gain: Gain of the spoken text in dB.
         
         """
-        # Create wave audio clip for overlaying
-        
-        engine = pyttsx3.init()
-        rate = engine.getProperty('rate')
-        engine.setProperty('rate', rate-100)
-        voices = engine.getProperty('voices') 
-        # Uncomment the following lines to see all the available voices
-        #for voice in voices: 
-        #    print(f'voice: {voice.name}')
-        
-        # This function depends on the voices installed in the system and requires index of the installed voices; which may vary.
-        engine.setProperty('voice', voice_index)
-        # Save created clip as tempory file and load into audWM
-        with tempfile.NamedTemporaryFile(mode="w", delete=False, prefix="Arch_") as wm:
-            engine.save_to_file(text=text_to_write, filename=wm.name+".wav")
-            
-            engine.runAndWait()
-            audWM = AudioSegment.from_wav(wm.name+".wav")
-            
-            # audio is a raw data so save it to temporary file, as pydub accepts file from disk only.
-            with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_") as org:
-                org.write(audio)
-                # load file to audOrigin; the original file
-                audOrigin = AudioSegment.from_ogg(file=org.name)
-                
-                # overlay both clips
-                clip: AudioSegment = audOrigin.overlay(audWM,loop=1)
-                
-                # save the newly created clip to temporary file for opening and exporting
-                with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_", suffix="."+"ogg") as f:
-                    clip.export(f.name,format="ogg")
-                    # open saved file and return buffer as BytesIO
-                    with open(f.name,"rb") as retFile:
-                        buffer = retFile.read()
-                        return BytesIO(buffer)
-
-    # This function uses pydub and ffmpeg. install ffmpeg and set environment variable to its bin folder
-    def WaterMark_MP3(self, audio: bytes, text_to_write: str, voice_index: int=28) -> BytesIO:
+        return self._waterMarkAudio(audio, text_to_write, voice_index, "ogg", interval, gain)
+
+    @_instrumented
+    @_cached
+    def WaterMark_MP3(self, audio: bytes, text_to_write: str, voice_index: int=28, interval: float=None, gain: float=0.0) -> BytesIO:
         '''
         Function creates a wav file with text to speech, overlays it with original audio and returns overlayed file
 
         :param audio: Retrived bytes of audio file as retrieved from read() function from database.
         
         :param text_to_write: The text required to be spoken by bot and watermarked in audio file.
+
+        :param interval: Seconds between the starts of the spoken text, default repeats it without pause.
+
+        :param gain: Gain of the spoken text in dB.
         
         '''
-        # Create wave audio clip for overlaying
-        engine = pyttsx3.init()
-        rate = engine.getProperty('rate')
-        engine.setProperty('rate', rate-100)
-        voices = engine.getProperty('voices')
-        #for voice in voices:
-        #    print(f'voice: {voice.name}')
-        
-        # This function depends on the voices installed in the system and requires index of the installed voices; which may vary.
-        engine.setProperty('voice', voice_index)
-        # Save created clip as tempory file and load into audWM
-        with tempfile.NamedTemporaryFile(mode="w", delete=False, prefix="Arch_") as wm:
-            engine.save_to_file(text=text_to_write, filename=wm.name+".mp3")
-            
-            engine.runAndWait()
-            audWM = AudioSegment.from_mp3(wm.name+".mp3")
-            # audio is a raw data so save it to temporary file, as pydub accepts file from disk only.
-            with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_") as org:
-                org.write(audio)
-                # load file to audOrigin; the original file
+        return self._waterMarkAudio(audio, text_to_write, voice_index, "mp3", interval, gain)
+
+    @_instrumented
+    def WaterMark_AudioStream(self, source, sink, text_to_write: str, format: str="wav", voice_index: int=28, interval: float=None, gain: float=0.0, chunk_seconds: float=10):
+        '''
+        Function watermarks an audio read from source into sink like WaterMark_WAV, WaterMark_OGG and WaterMark_MP3,
+        but in chunks, so the memory used stays the same whatever the length of the recording.
+
+        The audio is decoded by ffmpeg as it is read from source, the spoken text is mixed into every chunk of
+        chunk_seconds and the chunks are encoded by a second ffmpeg, or for wav written directly, as they come.
+        A wav written to a sink which can seek gets the sizes in its header filled in at the end, otherwise it
+        is marked as a stream of unknown length like ffmpeg does for pipes. A wav source keeps its sample format
+        in a wav sink, see _waterMarkAudio.
+
+        :param source: Readable binary file-like object with the audio in any format ffmpeg reads.
+
+        :param sink: Writable binary file-like object receiving the watermarked audio, which is returned.
+
+        :param text_to_write: The text required to be spoken by bot and watermarked in audio file.
+
+        :param format: Format written to sink, wav, ogg or mp3.
+
+        :param interval: Seconds between the starts of the spoken text, default repeats it without pause.
+
+        :param gain: Gain of the spoken text in dB.
+
+        :param chunk_seconds: Length of the chunks mixed at a time.
+        '''
+        if format not in ("wav", "ogg", "mp3"):
+            raise ValueError(f"Unsupported audio format {format!r}, use wav, ogg or mp3")
+        with _tempAccounting():
+            # the head tells the sample format of a wav source, and is fed to ffmpeg first
+            head = source.read(1 << 16) if format == "wav" else b""
+            sample = _wavSampleFormat(head) if format == "wav" else "s16"
+            sampleFormat = _sampleFormats[sample]
+            chunks = iter([head])
+            def read(size: int) -> bytes:
+                return next(chunks, None) or source.read(size)
+            decoder = _ffmpegProcess(["-i", "pipe:0", "-c:a", sampleFormat.codec, "-f", "wav", "pipe:1"])
+            feeder = _pump(read, decoder.process.stdin.write, decoder.process.stdin.close)
+            encoder = drain = None
+            try:
                 try:
-                    audOrigin = AudioSegment.from_file(file=org.name, format= "mp3")
-                except:
-                    audOrigin = AudioSegment.from_file(file=org.name, format= "mp3")
-                # overlay both clips
-                clip: AudioSegment = audOrigin.overlay(audWM)
-                
-                # save the newly created clip to temporary file for opening and exporting
-                with tempfile.NamedTemporaryFile(mode="w+b", delete=False, prefix="Arch_", suffix="."+"mp3") as f:
-                    clip.export(f.name,format="mp3")
-                    # open saved file and return buffer as BytesIO
-                    with open(f.name,"rb") as retFile:
-                        buffer = retFile.read()
-                        return BytesIO(buffer)
-            
+                    rate, channels = _readWavHeader(decoder.process.stdout)
+                except ValueError:
+                    # ffmpeg could not read source, its log tells why
+                    feeder.join()
+                    decoder.finish("decode the audio")
+                    raise
+                clip, period = self._speechClip(text_to_write, voice_index, format, rate, channels, interval, gain, sample)
+
+                if format == "wav":
+                    start = sink.tell() if sink.seekable() else None
+                    sink.write(_wavHeader(rate, channels, sample=sample))
+                    write = lambda samples: sink.write(_wavData(samples, sample))
+                else:
+                    encoder = _ffmpegProcess(["-f", "s16le", "-ar", str(rate), "-ac", str(channels), "-i", "pipe:0",
+                                              "-c:a", _audioCodecs[format], "-f", format, "pipe:1"])
+                    drain = _pump(encoder.process.stdout.read, sink.write)
+                    write = lambda samples: encoder.process.stdin.write(samples.tobytes())
+
+                chunkBytes = max(1, round(chunk_seconds * rate)) * channels * np.dtype(sampleFormat.dtype).itemsize
+                position = 0
+                while True:
+                    _checkCancelled()
+                    with _stage("decode"):
+                        data = decoder.process.stdout.read(chunkBytes)
+                    if not data:
+                        break
+                    samples = np.frombuffer(data, dtype=sampleFormat.dtype)
+                    samples = samples[:len(samples) - len(samples) % channels].reshape(-1, channels).copy()
+                    with _stage("mix"):
+                        _mixRepeated(samples, clip, period, position)
+                    position += len(samples)
+                    _count("samples", len(samples))
+                    with _stage("encode"):
+                        write(samples)
+
+                feeder.join()
+                decoder.finish("decode the audio")
+                if encoder is not None:
+                    encoder.process.stdin.close()
+                    drain.join()
+                    encoder.finish("encode the audio")
+                elif start is not None:
+                    sink.seek(start)
+                    sink.write(_wavHeader(rate, channels, position * channels * (sampleFormat.bits // 8), sample))
+                    sink.seek(0, os.SEEK_END)
+                return sink
+            finally:
+                decoder.kill()
+                if encoder is not None:
+                    encoder.kill()
+
+
+# Built in format handlers of WaterMarker.WaterMark
+def _imageHandler(format: str):
+    return lambda marker, data, text_to_write, max_size=None, workers=None: marker._waterMarkImage(data, text_to_write, format, max_size, workers)
+
+def _videoHandler(extension: str):
+    return lambda marker, data, text_to_write, **kwargs: marker.WaterMark_Video(data, text_to_write, extension=extension, **kwargs)
+
+# Major brands of ISO media files holding still images (HEIF, HEIC, AVIF) rather than video
+_imageBrands = {b"mif1", b"msf1", b"heic", b"heix", b"heim", b"heis", b"hevc", b"hevx", b"hevm", b"hevs", b"avif", b"avis"}
+
+def _isMP4(head: bytes) -> bool:
+    # ISO media file type box, unless its brand is one of the image formats sharing the container
+    return head[4:8] == b"ftyp" and head[8:12] not in _imageBrands
+
+def _isMP3(head: bytes) -> bool:
+    # ID3 tag or a bare MPEG audio frame sync
+    return head[:3] == b"ID3" or (len(head) > 1 and head[0] == 0xFF and head[1] & 0xE0 == 0xE0)
+
+# registered first so it is tried last: PDFs may have junk before %PDF-, so it is searched anywhere in the
+# sniffed bytes, and only files no other signature matches, e.g. not an image mentioning %PDF- in a comment
+WaterMarker.register_handler("pdf", WaterMarker.WaterMark_PDF, [lambda head: b"%PDF-" in head], media="pdf")
+WaterMarker.register_handler("jpeg", _imageHandler("jpeg"), [(0, b"\xff\xd8\xff")])
+WaterMarker.register_handler("png", _imageHandler("png"), [(0, b"\x89PNG\r\n\x1a\n")])
+WaterMarker.register_handler("tiff", _imageHandler("tiff"), [(0, b"II*\x00"), (0, b"MM\x00*"), (0, b"II+\x00"), (0, b"MM\x00+")])
+WaterMarker.register_handler("bmp", _imageHandler("bmp"), [(0, b"BM")])
+WaterMarker.register_handler("jpg", _imageHandler("jpeg"))
+WaterMarker.register_handler("tif", _imageHandler("tiff"))
+WaterMarker.register_handler("mp4", _videoHandler("mp4"), [_isMP4], media="video")
+WaterMarker.register_handler("avi", _videoHandler("avi"), [lambda head: head[:4] == b"RIFF" and head[8:12] == b"AVI "], media="video")
+WaterMarker.register_handler("webm", _videoHandler("webm"), [(0, b"\x1a\x45\xdf\xa3")], media="video")
+WaterMarker.register_handler("wav", WaterMarker.WaterMark_WAV, [lambda head: head[:4] == b"RIFF" and head[8:12] == b"WAVE"], media="audio")
+WaterMarker.register_handler("ogg", WaterMarker.WaterMark_OGG, [(0, b"OggS")], media="audio")
+# after ogg so that Ogg files carrying a Theora video stream are detected as video first
+WaterMarker.register_handler("ogv", _videoHandler("ogv"), [lambda head: head[:4] == b"OggS" and b"\x80theora" in head], media="video")
+WaterMarker.register_handler("mp3", WaterMarker.WaterMark_MP3, [_isMP3], media="audio")
+
+
+# State of a PDF worker process, set once per process by _initPdfWorker
+_pdfWorker = {}
+
+def _initPdfWorker(pdf: bytes, text_to_write: str, encoder_params: dict, scale: float=_PDF_SCALE):
+    """
+    Initializer of the PDF worker processes. Each worker opens its own copy of the document,
+    as pdfium documents can not be shared between processes.
+    """
+    _pdfWorker["pd"] = pdfium.PdfDocument(pdf)
+    _pdfWorker["text"] = text_to_write
+    _pdfWorker["marker"] = WaterMarker(encoder_params)
+    _pdfWorker["scale"] = scale
+
+def _waterMarkPdfPageInWorker(index: int) -> tuple:
+    """
+    Watermarks page index of the document opened by _initPdfWorker.
+    """
+    return _pdfWorker["marker"]._waterMarkPdfPage(_pdfWorker["pd"], index, _pdfWorker["text"], _pdfWorker["scale"])
+
+
+# WaterMarker of a video worker process, set once per process by _initVideoWorker
+_videoWorker = {}
+
+def _initVideoWorker(text_to_write: str, extension: str):
+    """
+    Initializer of the video segment worker processes.
+    """
+    _videoWorker["marker"] = WaterMarker()
+    _videoWorker["text"] = text_to_write
+    _videoWorker["extension"] = extension
+
+def _waterMarkVideoSegmentInWorker(job: tuple):
+    """
+    Watermarks the video segment file job[0] into job[1], without audio which is added when joining.
+    """
+    source, target = job
+    _videoWorker["marker"]._waterMarkVideoFile(source, target, _videoWorker["text"], _videoWorker["extension"], audio=False)
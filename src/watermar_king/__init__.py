@@ -1,2 +1,5 @@
 __package__ = 'watermar_king'
-from .WaterMarker import WaterMarker
+from .WaterMarker import WaterMarker, OverlayCache, SpeechCache, BatchResult, WaterMarkCancelled, preload
+from .AsyncWaterMarker import AsyncWaterMarker
+from .MetricsCollector import MetricsCollector
+from .ResultCache import ResultCache, MemoryStore, DiskStore
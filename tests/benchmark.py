@@ -0,0 +1,276 @@
+"""
+Benchmark of all WaterMarker methods on synthetic inputs.
+
+Run from the top level directory:
+
+    python -m tests.benchmark --output bench.json
+    python -m tests.benchmark --output new.json --baseline bench.json --threshold 0.15
+
+Inputs are generated locally: images of every font size width tier of the watermark, a multi page PDF,
+a short video with audio, and WAV, MP3 and OGG clips. Besides the format methods, the batch, the tiled
+TIFF, the per page PDF and the streaming audio paths are timed on the same inputs. Every case runs in its own process so its peak
+RSS is measured alone. The first call of a case warms up caches and is not measured. Cases which can
+not run here (e.g. no speech engine for the audio methods) are reported with their error.
+With --baseline the p50 latencies are compared, cases slower by more than threshold are listed and
+the exit code is 1.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from io import BytesIO
+
+import cv2
+import numpy as np
+
+# Widths of the font size tiers of _waterMark: <1000, <2000, <3000, <4000, <5000, >=5000
+IMAGE_WIDTHS = (800, 1500, 2500, 3500, 4500, 5500)
+IMAGE_FORMATS = {"JPEG": ".jpg", "PNG": ".png", "TIFF": ".tiff", "BMP": ".bmp"}
+PDF_PAGES = 10
+VIDEO_SECONDS = 5
+AUDIO_SECONDS = 30
+TEXT = "Benchmark watermark"
+BATCH_IMAGES = 16
+# Methods taking the input as a file instead of bytes
+FILE_METHODS = ("WaterMark_TIFF_Tiled", "WaterMark_AudioStream")
+
+
+def ffmpeg(*args):
+    import imageio_ffmpeg
+    subprocess.run([imageio_ffmpeg.get_ffmpeg_exe(), "-y", "-loglevel", "error"] + list(args), check=True)
+
+
+def synthetic_image(width: int):
+    # smooth gradients with noise, so images compress like photos and not like flat colour
+    height = width * 3 // 4
+    rng = np.random.default_rng(width)
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    img = np.stack([x / width * 255, y / height * 255, (x + y) / (width + height) * 255], axis=2)
+    img += rng.normal(0, 12, img.shape)
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def make_pdf(path: str):
+    import pypdfium2 as pdfium
+    from io import BytesIO
+    pd = pdfium.PdfDocument.new()
+    ok, jpeg = cv2.imencode(".jpg", synthetic_image(1240))
+    for _ in range(PDF_PAGES):
+        page = pd.new_page(595, 842)
+        image = pdfium.PdfImage.new(pd)
+        image.load_jpeg(BytesIO(jpeg.tobytes()), inline=True)
+        image.set_matrix(pdfium.PdfMatrix().scale(495, 371).translate(50, 400))
+        page.insert_obj(image)
+        page.gen_content()
+        page.close()
+    pd.save(path)
+    pd.close()
+
+
+def make_inputs(folder: str) -> dict:
+    """
+    Writes the synthetic inputs to folder and returns the cases as name -> (method, input file, kwargs).
+    """
+    cases = {}
+    for width in IMAGE_WIDTHS:
+        img = synthetic_image(width)
+        for format, ext in IMAGE_FORMATS.items():
+            path = os.path.join(folder, f"image_{width}{ext}")
+            cv2.imwrite(path, img)
+            cases[f"{format.lower()}_{width}"] = ("WaterMark_" + format, path, {})
+
+    path = os.path.join(folder, "document.pdf")
+    make_pdf(path)
+    cases["pdf_raster"] = ("WaterMark_PDF", path, {})
+    cases["pdf_raster_workers"] = ("WaterMark_PDF", path, {"workers": None})
+    cases["pdf_vector"] = ("WaterMark_PDF", path, {"mode": "vector"})
+
+    path = os.path.join(folder, "video.mp4")
+    ffmpeg("-f", "lavfi", "-i", f"testsrc2=size=1280x720:rate=30:duration={VIDEO_SECONDS}",
+           "-f", "lavfi", "-i", f"sine=frequency=440:duration={VIDEO_SECONDS}",
+           "-c:v", "libx264", "-pix_fmt", "yuv420p", "-g", "30", "-c:a", "aac", "-shortest", path)
+    cases["video_mp4"] = ("WaterMark_Video", path, {"extension": "mp4"})
+    cases["video_mp4_workers"] = ("WaterMark_Video", path, {"extension": "mp4", "workers": None, "segment_seconds": 1})
+
+    for format in ("wav", "mp3", "ogg"):
+        path = os.path.join(folder, "audio." + format)
+        ffmpeg("-f", "lavfi", "-i", f"sine=frequency=300:duration={AUDIO_SECONDS}:sample_rate=44100", "-ac", "2", path)
+        cases["audio_" + format] = ("WaterMark_" + format.upper(), path, {})
+        cases["audio_stream_" + format] = ("WaterMark_AudioStream", path, {"format": format})
+
+    cases["batch_jpeg_800"] = ("WaterMark_Batch", os.path.join(folder, "image_800.jpg"), {})
+    cases["batch_jpeg_800_unordered"] = ("WaterMark_Batch", os.path.join(folder, "image_800.jpg"), {"ordered": False})
+
+    width = IMAGE_WIDTHS[-1]
+    path = os.path.join(folder, f"tiled_{width}.tiff")
+    # the tiled method takes uncompressed TIFFs only
+    cv2.imwrite(path, synthetic_image(width), [cv2.IMWRITE_TIFF_COMPRESSION, 1])
+    cases[f"tiff_tiled_{width}"] = ("WaterMark_TIFF_Tiled", path, {})
+
+    path = os.path.join(folder, "document.pdf")
+    cases["pdf_pages"] = ("WaterMark_PDF_Pages", path, {})
+    cases["pdf_pages_jpeg"] = ("WaterMark_PDF_Pages", path, {"format": "jpeg", "scale": 1})
+    return cases
+
+
+def call(wm, method: str, data: bytes, path: str, kwargs: dict):
+    """
+    Calls method of wm once on the input data read from path, consuming generator results.
+    """
+    if method == "WaterMark_Batch":
+        for result in wm.WaterMark_Batch([(data, TEXT, None)] * BATCH_IMAGES, **kwargs):
+            if result.error is not None:
+                raise result.error
+    elif method == "WaterMark_PDF_Pages":
+        for _ in wm.WaterMark_PDF_Pages(data, TEXT, **kwargs):
+            pass
+    elif method == "WaterMark_TIFF_Tiled":
+        wm.WaterMark_TIFF_Tiled(path, path + ".out.tiff", TEXT, **kwargs)
+    elif method == "WaterMark_AudioStream":
+        with open(path, "rb") as source:
+            wm.WaterMark_AudioStream(source, BytesIO(), TEXT, **kwargs)
+    else:
+        getattr(wm, method)(data, TEXT, **kwargs)
+
+
+def peak_rss() -> int:
+    """
+    Returns the peak resident set size of this process in bytes, None where it is not available.
+    """
+    # VmHWM starts again with the program, ru_maxrss may carry the peak of the parent over the fork
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def run_case(method: str, path: str, kwargs: dict, repeat: int) -> dict:
+    """
+    Runs one case in this process and returns its measurements.
+    """
+    from watermar_king import WaterMarker
+    wm = WaterMarker()
+    data = None
+    # the file methods read path themselves, its bytes in memory would count against their peak RSS
+    if method not in FILE_METHODS:
+        with open(path, "rb") as file:
+            data = file.read()
+    # a batch watermarks its input BATCH_IMAGES times per call
+    inputBytes = os.path.getsize(path) * (BATCH_IMAGES if method == "WaterMark_Batch" else 1)
+    rssBefore = peak_rss()
+    # warm up: overlay and speech caches, worker pools, lazy initialisation
+    call(wm, method, data, path, kwargs)
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call(wm, method, data, path, kwargs)
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    return {
+        "method": method,
+        "kwargs": kwargs,
+        "input_bytes": inputBytes,
+        "repeat": repeat,
+        "p50": float(np.percentile(latencies, 50)),
+        "p99": float(np.percentile(latencies, 99)),
+        "mean": total / repeat,
+        "calls_per_second": repeat / total,
+        "mb_per_second": inputBytes * repeat / total / 1e6,
+        "peak_rss": peak_rss(),
+        "rss_before": rssBefore,
+    }
+
+
+def run_in_process(name: str, case: tuple, repeat: int) -> dict:
+    method, path, kwargs = case
+    spec = json.dumps({"method": method, "path": path, "kwargs": kwargs, "repeat": repeat})
+    result = subprocess.run([sys.executable, "-m", "tests.benchmark", "--case", spec], capture_output=True, text=True)
+    if result.returncode != 0:
+        lines = result.stderr.strip().splitlines()
+        return {"method": method, "kwargs": kwargs, "error": lines[-1] if lines else f"exit code {result.returncode}"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Returns (name, baseline p50, p50, ratio) of the cases slower than baseline by more than threshold.
+    """
+    slower = []
+    for name, result in results.items():
+        before = baseline.get(name)
+        if not before or "p50" not in before or "p50" not in result:
+            continue
+        ratio = result["p50"] / before["p50"]
+        if ratio > 1 + threshold:
+            slower.append((name, before["p50"], result["p50"], ratio))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of all WaterMarker methods on synthetic inputs")
+    parser.add_argument("--output", default="benchmark.json", help="JSON file the results are written to")
+    parser.add_argument("--baseline", help="JSON file of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Allowed p50 slowdown against the baseline, 0.15 is 15%%")
+    parser.add_argument("--repeat", type=int, default=5, help="Measured calls per case")
+    parser.add_argument("--only", help="Run the cases whose name contains this text")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        case = json.loads(args.case)
+        print(json.dumps(run_case(case["method"], case["path"], case["kwargs"], case["repeat"])))
+        return 0
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        cases = make_inputs(folder)
+        for name, case in cases.items():
+            if args.only and args.only not in name:
+                continue
+            result = run_in_process(name, case, args.repeat)
+            results[name] = result
+            if "error" in result:
+                print(f"{name:24} failed: {result['error']}")
+            else:
+                rss = f"{result['peak_rss'] / 2**20:8.0f} MB" if result["peak_rss"] else "       -"
+                print(f"{name:24} p50 {result['p50'] * 1000:9.1f} ms  p99 {result['p99'] * 1000:9.1f} ms  "
+                      f"{result['mb_per_second']:8.2f} MB/s  rss {rss}")
+
+    report = {
+        "meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                 "platform": platform.platform(), "cpu_count": os.cpu_count(),
+                 "numpy": np.__version__, "opencv": cv2.__version__, "repeat": args.repeat},
+        "results": results,
+    }
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+        slower = compare(results, baseline, args.threshold)
+        for name, before, after, ratio in slower:
+            print(f"SLOWER {name}: p50 {before * 1000:.1f} ms -> {after * 1000:.1f} ms ({(ratio - 1) * 100:+.0f}%)")
+        if slower:
+            return 1
+        print(f"No case slower than the baseline by more than {args.threshold:.0%}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 
 from watermar_king import WaterMarker
 import  os
+import numpy as np
 
 
 def create_folder():
@@ -19,6 +20,44 @@ def watermark_pdf(img, text_to_write, file_name):
             f.write(out.getbuffer())
     print("PDF file created")
 
+def check_pdf_vector(pdf, text_to_write):
+    # vector mode must leave the pages as they were: same text, and the same pixels without the watermark annotation
+    import pypdfium2 as pdfium
+    wm = WaterMarker()
+    with open(pdf, "rb") as f:
+        original = f.read()
+    out = wm.WaterMark_PDF(original, text_to_write=text_to_write, mode="vector")
+    before, after = pdfium.PdfDocument(original), pdfium.PdfDocument(out.getvalue())
+    assert len(before) == len(after)
+    for index in range(len(before)):
+        old, new = before[index], after[index]
+        assert old.get_textpage().get_text_bounded() == new.get_textpage().get_text_bounded(), f"text of page {index} changed"
+        rendered = old.render(scale=1, draw_annots=False).to_numpy()
+        assert np.array_equal(rendered, new.render(scale=1, draw_annots=False).to_numpy()), f"page {index} changed"
+        assert not np.array_equal(rendered, new.render(scale=1).to_numpy()), f"page {index} has no watermark"
+    print("PDF vector mode checked")
+
+def check_result_cache(img, text_to_write, calls=8):
+    # identical calls made at the same time must watermark the image once and all get the same output
+    from watermar_king import ResultCache
+    from concurrent.futures import ThreadPoolExecutor
+    import threading
+    cache = ResultCache()
+    wm = WaterMarker(result_cache=cache)
+    with open(img, "rb") as image:
+        data = image.read()
+    start = threading.Barrier(calls)
+    def call(_):
+        start.wait()
+        return wm.WaterMark_PNG(data, text_to_write=text_to_write).getvalue()
+    with ThreadPoolExecutor(max_workers=calls) as executor:
+        outputs = list(executor.map(call, range(calls)))
+    stats = cache.stats()
+    assert stats["misses"] == 1, f"computed {stats['misses']} times"
+    assert stats["hits"] + stats["shared"] == calls - 1
+    assert all(output == outputs[0] for output in outputs)
+    print("Result cache checked")
+
 def watermark_jpeg(img, text_to_write, file_name):
     wm = WaterMarker()
     create_folder()
@@ -31,6 +70,29 @@ def watermark_jpeg(img, text_to_write, file_name):
             f.write(out.getbuffer())
     print("JPEG file created")
 
+def check_blend(img, text_to_write):
+    # blending only the text bands must give exactly the blend with the whole overlay image, drawn here
+    # on a full size canvas the way the overlay always was
+    import cv2
+    import sys
+    wm = WaterMarker()
+    marks = sys.modules["watermar_king.WaterMarker"]._waterMark
+    with open(img, "rb") as image:
+        original = cv2.imdecode(np.frombuffer(image.read(), np.uint8), cv2.IMREAD_COLOR)
+    rng = np.random.default_rng(0)
+    pictures = [original, cv2.resize(original, (800, 600))]
+    pictures += [rng.integers(0, 256, (height, width, 3), np.uint8) for width in range(60, 2600, 47) for height in (41, 333)]
+    for picture in pictures:
+        mark = marks(picture.shape[1], picture.shape[0], text_to_write)
+        overlay = np.zeros_like(picture)
+        for percent in (25, 50, 75):
+            textY = int(picture.shape[0] * percent / 100)
+            cv2.putText(overlay, text=text_to_write, org=(mark.textX, textY), fontFace=mark.font, fontScale=mark.font_size, color=(200, 200, 200), thickness=mark.thickness, lineType=cv2.LINE_8)
+        overlay = cv2.bitwise_not(overlay)
+        expected = cv2.addWeighted(picture, 0.7, overlay, 0.3, 0.5)
+        assert np.array_equal(wm._blendWaterMark(picture.copy(), text_to_write), expected), f"blend of {picture.shape} differs"
+    print("Blend checked")
+
 def watermark_png(img, text_to_write, file_name):
     wm = WaterMarker()
     create_folder()
@@ -55,6 +117,39 @@ def watermark_tiff(img, text_to_write, file_name):
             f.write(out.getbuffer())
     print("TIFF file created")
 
+def check_tiff_pages(img, text_to_write):
+    # every page of a multi-page TIFF must be kept and watermarked as if it was a single page TIFF
+    import cv2
+    wm = WaterMarker()
+    with open(img, "rb") as image:
+        first = cv2.imdecode(np.frombuffer(image.read(), np.uint8), cv2.IMREAD_COLOR)
+    pages = [first, cv2.resize(first, (first.shape[1] // 2, first.shape[0] // 3)), np.full((200, 300, 3), 90, np.uint8)]
+    ok, data = cv2.imencodemulti(".tiff", pages)
+    ok, output = cv2.imdecodemulti(np.frombuffer(wm.WaterMark_TIFF(data.tobytes(), text_to_write=text_to_write).getvalue(), np.uint8), cv2.IMREAD_COLOR)
+    assert ok and len(output) == len(pages), "pages were lost"
+    for index, page in enumerate(pages):
+        single = wm.WaterMark_TIFF(cv2.imencode(".tiff", page)[1].tobytes(), text_to_write=text_to_write).getvalue()
+        assert np.array_equal(output[index], cv2.imdecode(np.frombuffer(single, np.uint8), cv2.IMREAD_COLOR)), f"page {index} differs"
+    print("Multi-page TIFF checked")
+
+def check_tiff_tiled(img, text_to_write):
+    # watermarking an uncompressed TIFF strip by strip must give the pixels of WaterMark_TIFF
+    import cv2
+    import tempfile
+    wm = WaterMarker()
+    with open(img, "rb") as image:
+        picture = cv2.imdecode(np.frombuffer(image.read(), np.uint8), cv2.IMREAD_COLOR)
+    ok, data = cv2.imencode(".tiff", picture, [cv2.IMWRITE_TIFF_COMPRESSION, 1, cv2.IMWRITE_TIFF_ROWSPERSTRIP, 7])
+    expected = cv2.imdecode(np.frombuffer(wm.WaterMark_TIFF(data.tobytes(), text_to_write=text_to_write).getvalue(), np.uint8), cv2.IMREAD_COLOR)
+    with tempfile.TemporaryDirectory() as folder:
+        source, target = os.path.join(folder, "source.tiff"), os.path.join(folder, "target.tiff")
+        with open(source, "wb") as f:
+            f.write(data.tobytes())
+        # a few strips at a time, so the overlay is split across chunks
+        wm.WaterMark_TIFF_Tiled(source, target, text_to_write, chunk_bytes=picture.shape[1] * 3 * 20)
+        assert np.array_equal(cv2.imread(target, cv2.IMREAD_COLOR), expected), "tiled TIFF differs"
+    print("Tiled TIFF checked")
+
 def watermark_bmp(img, text_to_write, file_name):
     wm = WaterMarker()
     create_folder()
@@ -67,6 +162,31 @@ def watermark_bmp(img, text_to_write, file_name):
             f.write(out.getbuffer())
     print("BMP file created")
 
+def watermark_file(path, text_to_write, file_name):
+    wm = WaterMarker()
+    create_folder()
+    file_name = os.path.join(os.getcwd(), "output", file_name) 
+    with open(path, "rb") as data:
+        out = wm.WaterMark(data.read(), text_to_write=text_to_write)
+        with open(file_name, "wb") as f:
+            f.write(out.getbuffer())
+    print("File of detected format created")
+
+def check_detect_format(img):
+    # an image mentioning %PDF- in its header must still be detected as the image it is
+    import cv2
+    with open(img, "rb") as image:
+        data = image.read()
+    comment = b"see attached %PDF-1.7 spec"
+    # JPEG comment segment right after the start of image marker
+    data = data[:2] + b"\xff\xfe" + (len(comment) + 2).to_bytes(2, "big") + comment + data[2:]
+    assert cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR) is not None
+    assert WaterMarker.detect_format(data) == "jpeg", f"detected as {WaterMarker.detect_format(data)}"
+    assert WaterMarker().WaterMark(data, text_to_write="Watermarking this image").getvalue()[:3] == b"\xff\xd8\xff"
+    with open("tests/sample_pdf.pdf", "rb") as pdf:
+        assert WaterMarker.detect_format(b"\r\n" + pdf.read()) == "pdf"
+    print("Format detection checked")
+
 def watermark_video(video, text_to_write, file_name):
     wm = WaterMarker()
     create_folder()
@@ -118,10 +238,17 @@ def watermark_ogg(audio, text_to_write, file_name):
 
 if __name__ == "__main__":
     watermark_pdf("tests/sample_pdf.pdf", "Watermarking this PDF image", "output_pdf.pdf")
+    check_pdf_vector("tests/sample_pdf.pdf", "Watermarking this PDF")
     watermark_jpeg("tests/sample_jpeg.jpg", "Watermarking this JPEG image", "output_jpeg.jpg")    
     watermark_png("tests/sample_png.png", "Watermarking this PNG image", "output_png.png")
+    check_blend("tests/sample_jpeg.jpg", "Watermarking this JPEG image")
+    check_detect_format("tests/sample_jpeg.jpg")
     watermark_tiff("tests/sample_tiff.tiff", "Watermarking this TIFF image", "output_tiff.tiff")
+    check_tiff_pages("tests/sample_tiff.tiff", "Watermarking this TIFF image")
+    check_tiff_tiled("tests/sample_tiff.tiff", "Watermarking this TIFF image")
+    check_result_cache("tests/sample_png.png", "Watermarking this PNG image")
     watermark_bmp("tests/sample_bmp.bmp", "Watermarking this BMP image", "output_bmp.bmp")
+    watermark_file("tests/sample_png.png", "Watermarking this detected image", "output_detected.png")
     watermark_mp3("tests/sample_mp3.mp3", "Watermarking this audio", "output_mp3.mp3")
     watermark_wav("tests/sample_wav.wav", "Watermarking this audio", "output_wav.wav")
     watermark_ogg("tests/sample_ogg.ogg", "Watermarking this audio", "output_ogg.ogg")